@@ -1,8 +1,26 @@
 import streamlit as st
 import os
-import json
+import re
+import sqlite3
+import asyncio
+import codecs
+import csv
+import hashlib
+import html
+import io
+import math
+import textwrap
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from openai import OpenAI
+import httpx
+import numpy as np
+import orjson
+from markdown_it import MarkdownIt
+from openai import OpenAI, AsyncOpenAI, APITimeoutError
 from pathlib import Path
 
 # ==========================================
@@ -15,8 +33,8 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# 自定义 CSS 样式
-st.markdown("""
+# 自定义 CSS 样式（常量，避免每次 rerun 走 Markdown 渲染管线）
+CUSTOM_CSS = """
 <style>
     .main-header {
         font-size: 2rem;
@@ -33,33 +51,38 @@ st.markdown("""
         padding-bottom: 0.5rem;
         border-bottom: 2px solid #3498db;
     }
-    .role-item {
-        background-color: #f8f9fa;
+    .role-item, .task-item {
         padding: 0.5rem;
         margin: 0.3rem 0;
-        border-left: 3px solid #3498db;
         border-radius: 3px;
     }
+    .role-item {
+        background-color: #f8f9fa;
+        border-left: 3px solid #3498db;
+    }
     .task-item {
         background-color: #fff3cd;
-        padding: 0.5rem;
-        margin: 0.3rem 0;
         border-left: 3px solid #ffc107;
-        border-radius: 3px;
     }
-    .detection-pass {
-        background-color: #d4edda;
-        border: 1px solid #c3e6cb;
+    .detection-pass, .detection-fail {
         border-radius: 5px;
         padding: 1rem;
         margin: 1rem 0;
     }
+    .detection-pass {
+        background-color: #d4edda;
+        border: 1px solid #c3e6cb;
+    }
     .detection-fail {
         background-color: #f8d7da;
         border: 1px solid #f5c6cb;
-        border-radius: 5px;
-        padding: 1rem;
-        margin: 1rem 0;
+    }
+    .analysis-text {
+        white-space: pre-wrap;
+        font-family: inherit;
+        background: none;
+        margin: 0.5rem 0 0;
+        padding: 0;
     }
     .field-label {
         font-weight: bold;
@@ -67,7 +90,15 @@ st.markdown("""
         margin-top: 1rem;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+@st.cache_data(show_spinner=False)
+def render_static_markdown(markdown_text: str) -> str:
+    """将静态说明文字预渲染为 HTML（结果缓存，rerun 时直接复用）"""
+    return MarkdownIt().render(textwrap.dedent(markdown_text))
+
+# 每次运行都需重新输出样式：rerun 中未再次输出的元素会被 Streamlit 清除
+st.html(CUSTOM_CSS)
 
 # ==========================================
 # 顶部：项目说明
@@ -75,7 +106,7 @@ st.markdown("""
 st.markdown('<div class="main-header">⚖️ 法律数据构建平台</div>', unsafe_allow_html=True)
 
 with st.expander("📋 项目说明", expanded=True):
-    st.markdown("""
+    st.html(render_static_markdown("""
     **项目背景：**
     
     当前的大语言模型在简单的行业问题上表现良好（如"盗窃罪判几年？"），但在复杂的真实场景中缺乏深度，
@@ -83,34 +114,32 @@ with st.expander("📋 项目说明", expanded=True):
     通过行业专家设计具有挑战性的问题来提升AI的专业能力。
     
     **您的角色：**
-    """)
+    """))
     
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.markdown("""
+        st.html(render_static_markdown("""
         - ⚖️ **法律**：律所律师、法官
         - 💼 **经济金融**：分析师、会计师
-        """)
+        """))
     with col2:
-        st.markdown("""
+        st.html(render_static_markdown("""
         - 🏥 **医疗**：主治医师
         - 🔬 **科研**：研究人员
-        """)
+        """))
     with col3:
-        st.markdown("""
+        st.html(render_static_markdown("""
         - 📊 **其他专业领域**专家
-        """)
+        """))
     
-    st.markdown("""
+    st.html(render_static_markdown("""
     **您的任务：**
-    """)
     
-    st.markdown("""
     1. 出一道您领域中真实的高难度的"案例分析题"
     2. 自己写出"答案思考过程"及"标准答案"
     3. 制定一套严格的"评分细则(Rubrics)"
     4. 然后给两个"实习生"(AI模型)的回答进行打分
-    """)
+    """))
 
 # ==========================================
 # 侧边栏：API 配置
@@ -145,18 +174,133 @@ with st.sidebar:
 # ==========================================
 # API 调用函数（模块化）
 # ==========================================
-def get_openai_client():
-    """获取 OpenAI 客户端（兼容 DeepSeek）"""
+# 请求超时（秒）：分析类请求输出较短，生成类请求输出较长
+ANALYZE_TIMEOUT = 30.0
+GENERATE_TIMEOUT = 60.0
+# 超时或连接失败时的重试次数（由 OpenAI SDK 按指数退避自动重发）
+MAX_RETRIES = 2
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key_value: str, base_url: str) -> OpenAI:
+    """获取 OpenAI 客户端（兼容 DeepSeek），按 (api_key, base_url) 缓存以复用连接池"""
+    return OpenAI(
+        api_key=api_key_value,
+        base_url=base_url,
+        http_client=build_http_client(httpx.Client),
+        max_retries=MAX_RETRIES
+    )
+
+def build_http_client(client_cls):
+    """创建 httpx 客户端：已安装 h2 时启用 HTTP/2（单连接多路复用并发请求），否则使用 HTTP/1.1"""
+    options = {
+        "limits": httpx.Limits(max_keepalive_connections=16, max_connections=32),
+        "timeout": httpx.Timeout(GENERATE_TIMEOUT, connect=10.0)
+    }
+    try:
+        return client_cls(http2=True, **options)
+    except ImportError:
+        return client_cls(**options)
+
+# 并发请求数上限（避免触发 API 限流）
+MAX_CONCURRENT_REQUESTS = 4
+# 流式输出的刷新阈值：累积字符数或距上次刷新的秒数达到其一即刷新显示
+STREAM_FLUSH_CHARS = 64
+STREAM_FLUSH_INTERVAL = 0.05
+
+def resolve_api_config():
+    """解析当前生效的 API Key 和 Base URL"""
     api_key_value = api_key or os.getenv("DEEPSEEK_API_KEY", "")
+    return api_key_value, base_url or "https://api.deepseek.com"
+
+def build_messages(prompt: str, system_prompt: str = ""):
+    """构建对话消息列表"""
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def completion_params(prompt: str, system_prompt: str, temperature: float, max_tokens: int, model: str):
+    """构建 chat.completions 请求参数（max_tokens 为 None 时不限制输出长度）"""
+    params = {
+        "model": model,
+        "messages": build_messages(prompt, system_prompt),
+        "temperature": temperature
+    }
+    if max_tokens is not None:
+        params["max_tokens"] = max_tokens
+    return params
+
+def format_api_error(e: Exception):
+    """将 API 异常转换为界面显示的错误提示"""
+    if isinstance(e, APITimeoutError):
+        return f"❌ API 调用超时（已自动重试 {MAX_RETRIES} 次），请稍后重试"
+    return f"❌ API 调用失败：{str(e)}"
+
+def request_completion(prompt: str, system_prompt: str = "", temperature: float = 0.7, max_tokens: int = None,
+                       model: str = None, request_timeout: float = GENERATE_TIMEOUT):
+    """调用 DeepSeek API 并返回文本，出错时直接抛出异常"""
+    api_key_value, base_url_value = resolve_api_config()
     if not api_key_value:
-        return None
+        raise ValueError("未配置 API Key，请在侧边栏输入")
+    client = get_openai_client(api_key_value, base_url_value).with_options(timeout=request_timeout)
     
-    return OpenAI(
-        api_key=api_key_value,
-        base_url=base_url or "https://api.deepseek.com"
+    response = client.chat.completions.create(
+        **completion_params(prompt, system_prompt, temperature, max_tokens, model or model_name)
+    )
+    return response.choices[0].message.content
+
+def stream_deepseek(prompt: str, system_prompt: str = "", temperature: float = 0.7, max_tokens: int = None,
+                    request_timeout: float = GENERATE_TIMEOUT, model: str = None):
+    """
+    以流式方式调用 DeepSeek API，逐段产出生成的文本（出错时直接抛出异常）
+    
+    Args:
+        prompt: 用户提示词
+        system_prompt: 系统提示词
+        temperature: 温度参数（0-1）
+        max_tokens: 输出 token 上限，None 表示不限制
+        request_timeout: 超时（秒），流式输出时为相邻数据块之间的最长等待
+        model: 模型名称，默认使用侧边栏选择的模型
+    
+    Yields:
+        增量文本片段
+    """
+    api_key_value, base_url_value = resolve_api_config()
+    if not api_key_value:
+        raise ValueError("未配置 API Key，请在侧边栏输入")
+    client = get_openai_client(api_key_value, base_url_value).with_options(timeout=request_timeout)
+    
+    response = client.chat.completions.create(
+        **completion_params(prompt, system_prompt, temperature, max_tokens, model or model_name),
+        stream=True
     )
+    for chunk in response:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
 
-def call_deepseek_api(prompt: str, system_prompt: str = "", temperature: float = 0.7):
+def stream_completion(prompt: str, system_prompt: str, temperature: float, max_tokens: int, stream_placeholder,
+                      request_timeout: float = GENERATE_TIMEOUT, model: str = None):
+    """流式调用 DeepSeek API，边接收边渲染到 stream_placeholder，返回完整文本（出错时抛出异常）"""
+    # 累积到列表中再 join，避免逐段拼接字符串的 O(n²) 开销；
+    # 按字符数或时间间隔合并刷新，避免每个 token 都触发一次前端重绘
+    buf = []
+    pending = 0
+    last_flush = time.monotonic()
+    for delta in stream_deepseek(prompt, system_prompt, temperature, max_tokens, request_timeout, model):
+        buf.append(delta)
+        pending += len(delta)
+        if pending >= STREAM_FLUSH_CHARS or time.monotonic() - last_flush > STREAM_FLUSH_INTERVAL:
+            stream_placeholder.markdown("".join(buf))
+            pending = 0
+            last_flush = time.monotonic()
+    text = "".join(buf)
+    stream_placeholder.markdown(text)
+    return text
+
+def call_deepseek_api(prompt: str, system_prompt: str = "", temperature: float = 0.7, max_tokens: int = None,
+                      request_timeout: float = GENERATE_TIMEOUT, stream_placeholder=None,
+                      use_cache: bool = True):
     """
     调用 DeepSeek API
     
@@ -164,417 +308,1843 @@ def call_deepseek_api(prompt: str, system_prompt: str = "", temperature: float =
         prompt: 用户提示词
         system_prompt: 系统提示词
         temperature: 温度参数（0-1）
+        max_tokens: 输出 token 上限，None 表示不限制
+        request_timeout: 单次请求超时（秒），超时后自动重试
+        stream_placeholder: st.empty() 占位符；提供时以流式方式实时显示生成内容
+        use_cache: 是否按请求内容读写响应缓存（调用方自行缓存时传 False）
     
     Returns:
         API 返回的文本内容
     """
-    client = get_openai_client()
-    if not client:
+    api_key_value, _ = resolve_api_config()
+    if not api_key_value:
         return "❌ 错误：未配置 API Key，请在侧边栏输入"
     
+    cache_key = request_cache_key(prompt, system_prompt, temperature, max_tokens) if use_cache else None
+    if cache_key is not None:
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            return cached
+    
     try:
-        messages = []
-        if system_prompt:
-            messages.append({"role": "system", "content": system_prompt})
-        messages.append({"role": "user", "content": prompt})
-        
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages,
-            temperature=temperature
-        )
-        
-        return response.choices[0].message.content
+        if stream_placeholder is not None:
+            result = stream_completion(prompt, system_prompt, temperature, max_tokens, stream_placeholder,
+                                       request_timeout=request_timeout)
+        else:
+            result = request_completion(prompt, system_prompt, temperature, max_tokens,
+                                        request_timeout=request_timeout)
     except Exception as e:
-        return f"❌ API 调用失败：{str(e)}"
+        return format_api_error(e)
+    if cache_key is not None:
+        store_cached_response(cache_key, result)
+    return result
 
-def analyze_source_text(source_text: str):
-    """分析原始判决文本"""
-    system_prompt = """你是一位法律大模型基准测试（Benchmark）的数据专家。我正在构建一个用于测评 Legal LLM 的数据集，核心考察维度为复杂案情分析能力（特别是多罪名认定）和外部知识库检索（RAG）能力。
-请审核以下[待测案件]，并根据下列标准进行 1-5 分的打分：
-1. 多罪名分析维度：
-5分：案情复杂，涉及两个及以上罪名，且罪名之间存在竞合、牵连关系或事实交叉，需要极强的逻辑拆解能力（例如：既涉嫌诈骗又涉嫌非法吸收公众存款）。
-3分：涉及多个罪名，但各罪名事实独立，界限清晰，推理难度一般。
-1分：单一罪名或案情极其简单。
-2. 检索依赖维度：
-5分：必须检索特定的地方法规、行业规范、司法解释或复杂的过往判例才能做出准确判断（仅凭通用法律常识无法回答）。
-3分：需要引用具体的刑法条款，但属于常见条款。
-1分：仅凭常识或基础法理即可回答，无需外部检索。
-输出要求： 【YES / NO】（总分≥6分）"""
-    
-    prompt = f"请分析以下判决文本：\n\n{source_text}"
-    return call_deepseek_api(prompt, system_prompt, temperature=0.7)
+def get_async_client(request_timeout: float = GENERATE_TIMEOUT) -> AsyncOpenAI:
+    """创建异步 DeepSeek 客户端（异步客户端绑定事件循环，因此每批请求单独创建）"""
+    api_key_value, base_url_value = resolve_api_config()
+    if not api_key_value:
+        raise ValueError("未配置 API Key，请在侧边栏输入")
+    return AsyncOpenAI(api_key=api_key_value, base_url=base_url_value,
+                       http_client=build_http_client(httpx.AsyncClient),
+                       timeout=request_timeout, max_retries=MAX_RETRIES)
 
-def generate_question(source_text: str):
-    """生成法律题目"""
-    system_prompt = """Role: 你是一位资深的法律人工智能专家，专门负责构建高难度的 Legal LLM（法律大语言模型）评测数据集。你擅长将原始案例转化为考察模型"深度逻辑推理"与"知识检索精准度"的复杂题目。  
-Task: 请参考提供的示例，对案情素材进行二次加工，构造出一个高质量的法律测评问题及其配套的"题目评价"。  
-核心考察维度（必须在题目中体现）,同时注意避免AI味过重：  
-复杂案情分析能力： 侧重多罪名认定、罪名交叉、罪数形态（自首、立功、并罚等）的判定。  
-RAG 能力测试点： 题目须要求模型必须结合特定的外部法律条文、司法解释或行业规则（如香港上市规则、刑法特定章节）进行回答。  
-构造规范：  
-    问题背景： 需包含干扰信息和高度细节化的案情描述，以模拟真实法律文书环境，不要包含法院判决或相关信息。  
-    问题设计： 增强问题难度，针对案件中较难的疑难点进行提问（注意不要太直接的提问），例如准确罪名预测和刑期预测。  
-    问题检测： 评价该题目在法律认知复杂度、区分度以及检索必要性方面的优势。  
-"""
-    
-    prompt = f"请根据以下案情生成一道法律题目：\n\n{source_text}"
-    return call_deepseek_api(prompt, system_prompt, temperature=0.8)
+async def _acomplete(client, semaphore, prompt: str, system_prompt: str = "", temperature: float = 0.7,
+                     max_tokens: int = None, model: str = None, **create_kwargs):
+    """异步调用 DeepSeek API 并返回完整响应对象（受信号量限流）"""
+    async with semaphore:
+        return await client.chat.completions.create(
+            **completion_params(prompt, system_prompt, temperature, max_tokens, model or model_name),
+            **create_kwargs
+        )
 
-def generate_answer(question: str, source_text: str):
-    """生成解题思路和答案"""
-    system_prompt = """你是一位资深的法律教育专家，擅长根据案件详情和题目要求，生成高质量的标准答案和详细的解题思路。
+async def _acall(client, semaphore, prompt: str, system_prompt: str = "", temperature: float = 0.7,
+                 max_tokens: int = None, model: str = None):
+    """异步调用 DeepSeek API 并返回文本（受信号量限流）"""
+    response = await _acomplete(client, semaphore, prompt, system_prompt, temperature, max_tokens, model=model)
+    return response.choices[0].message.content
 
-你的任务是：
-1. 仔细阅读并理解PDF文件中的案件详情和背景信息
-2. 根据题目中给出的案件背景，深入分析问题的核心要点
-3. 提供详细的解题思路，包括：
-   - 问题分析：识别题目中的关键法律问题和争议焦点
-   - 法律依据：引用相关的法律条文、司法解释或判例
-   - 推理过程：逐步分析案件的逻辑链条和推理步骤
-   - 结论形成：基于案件事实和法律依据得出最终结论
-4. 给出完整、准确、专业的标准答案
+def gather_completions(requests, max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+                       request_timeout: float = GENERATE_TIMEOUT, model: str = None):
+    """并发执行多个 DeepSeek API 请求，返回与输入顺序一致的结果（失败项为异常对象）"""
+    client = get_async_client(request_timeout)
+    
+    async def _gather():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        async with client:
+            return await asyncio.gather(
+                *(_acall(client, semaphore, *request, model=model) for request in requests),
+                return_exceptions=True
+            )
+    
+    return asyncio.run(_gather())
 
-要求：
-- 答案必须基于案件详情，不能脱离案件背景
-- 思考思路要详细、逻辑清晰、条理分明
-- 标准答案要准确、完整、具有权威性
-- 使用专业、规范的法律术语
-- 适当引用法律条文和司法解释作为支撑"""
+def run_many(requests, max_concurrency: int = MAX_CONCURRENT_REQUESTS,
+             request_timeout: float = GENERATE_TIMEOUT):
+    """
+    并发执行多个 DeepSeek API 请求
+    
+    Args:
+        requests: 请求列表，每项为 (prompt, system_prompt, temperature, max_tokens)
+        max_concurrency: 同时进行的最大请求数
+        request_timeout: 单次请求超时（秒），超时后自动重试
+    
+    Returns:
+        与 requests 顺序一致的文本结果列表（失败项为错误提示）
+    """
+    api_key_value, _ = resolve_api_config()
+    if not api_key_value:
+        return ["❌ 错误：未配置 API Key，请在侧边栏输入"] * len(requests)
     
-    prompt = f"""请根据以下人工审核过的题目和案件详情，生成详细的解题思路和标准答案：
+    results = gather_completions(requests, max_concurrency, request_timeout)
+    return [
+        format_api_error(result) if isinstance(result, Exception) else result
+        for result in results
+    ]
 
-【题目和问题】
-{question}
+def is_context_length_error(e: Exception):
+    """判断异常是否由输入超出模型上下文长度引起"""
+    message = str(e).lower()
+    return "context_length_exceeded" in message or "context length" in message
 
-【案件详情（来自PDF文件）】
-{source_text}
+# ==========================================
+# 长文本处理函数（token 计数与分块）
+# ==========================================
+# 超过该 token 数的判决文本改为分块并发分析后再汇总（map-reduce），单次分析请求的输入因此不超过该上限
+MAP_REDUCE_THRESHOLD_TOKENS = 8000
+# 题目生成与答案生成时案件文本的 token 上限，超出部分截断
+QUESTION_TOKEN_CAP = 8000
+ANSWER_TOKEN_CAP = 12000
+# 每个分块的 token 上限
+CHUNK_MAX_TOKENS = 3000
+# 每个分块的初始句子数；遇到上下文超长错误时按步长缩小
+CHUNK_SENTENCES = 90
+CHUNK_SENTENCES_STEP = 20
 
-请按照以下结构组织你的回答：
+# 按中英文句末标点及换行切分句子
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[。！？；!?])|(?<=\.)\s+|\n+")
 
-## 一、解题思路
+# 无法使用 tiktoken 时按每个字符计 2 个 token 估算：cl100k 编码下常见汉字约 1~2 个 token，
+# 按字符数计数会低估中文文本，导致超长提示词绕过上限
+FALLBACK_TOKENS_PER_CHAR = 2
 
-### 1. 问题分析
-（识别题目中的关键法律问题、争议焦点等）
+@st.cache_resource(show_spinner=False)
+def _token_encoder():
+    """
+    延迟加载 tiktoken 编码器，未安装或加载失败时返回 None
+    
+    首次使用时 tiktoken 需从 openaipublic.blob.core.windows.net 下载编码文件，网络不可达时会抛出异常；
+    离线部署可预先下载并通过 TIKTOKEN_CACHE_DIR 环境变量指定缓存目录。
+    失败结果同样被缓存，不会在每次 rerun 时重复尝试下载
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
 
-### 2. 案件事实梳理
-（从案件详情中提取与题目相关的关键事实）
+def count_tokens(text: str) -> int:
+    """统计文本的 token 数（无法使用 tiktoken 时按 FALLBACK_TOKENS_PER_CHAR 从高估计）"""
+    encoder = _token_encoder()
+    if encoder is None:
+        return len(text) * FALLBACK_TOKENS_PER_CHAR
+    return len(encoder.encode(text))
 
-### 3. 法律依据
-（引用相关的法律条文、司法解释、判例等）
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """将文本截断到 max_tokens 个 token 以内（无法使用 tiktoken 时按估算的字符数截断）"""
+    encoder = _token_encoder()
+    if encoder is None:
+        return text[:max_tokens // FALLBACK_TOKENS_PER_CHAR]
+    token_ids = encoder.encode(text)
+    if len(token_ids) <= max_tokens:
+        return text
+    return encoder.decode(token_ids[:max_tokens])
 
-### 4. 推理过程
-（逐步分析案件的逻辑链条，说明如何从事实推导出结论）
+# 按行切分段落（保留行尾换行符，拼接后与原文一致）
+_PARAGRAPH_SPLIT_RE = re.compile(r"(?<=\n)")
 
-### 5. 结论形成
-（基于以上分析，形成最终结论）
+@st.cache_data(show_spinner=False, max_entries=64)
+def budget_source_context(text: str, max_tokens: int) -> str:
+    """
+    按段落边界将文本裁剪到 max_tokens 个 token 以内，避免在句子中间截断
+    
+    Args:
+        text: 案件文本
+        max_tokens: token 上限
+    
+    Returns:
+        不超过上限的完整段落前缀（首段即超限时退化为按 token 截断）
+    """
+    parts = []
+    used = 0
+    for paragraph in _PARAGRAPH_SPLIT_RE.split(text):
+        paragraph_tokens = count_tokens(paragraph)
+        if used + paragraph_tokens > max_tokens:
+            if not parts:
+                return truncate_to_tokens(paragraph, max_tokens)
+            return "".join(parts).rstrip()
+        parts.append(paragraph)
+        used += paragraph_tokens
+    return text
 
-## 二、标准答案
+def split_sentences(text: str):
+    """将文本切分为句子列表"""
+    return [sentence for sentence in _SENTENCE_SPLIT_RE.split(text) if sentence.strip()]
 
-（给出完整、准确、专业的标准答案，确保答案基于案件详情，逻辑严密，具有说服力）
-"""
-    return call_deepseek_api(prompt, system_prompt, temperature=0.7)
+def chunk_sentences(sentences, max_sentences: int, max_tokens: int = CHUNK_MAX_TOKENS):
+    """将句子按数量上限和 token 上限依次分组，返回文本块列表"""
+    chunks = []
+    current = []
+    current_tokens = 0
+    for sentence in sentences:
+        sentence_tokens = count_tokens(sentence)
+        if current and (len(current) >= max_sentences or current_tokens + sentence_tokens > max_tokens):
+            chunks.append("\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(sentence)
+        current_tokens += sentence_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
 
-# ==========================================
-# 初始化 Session State
-# ==========================================
-if "source_text" not in st.session_state:
-    st.session_state.source_text = ""
-if "source_analysis" not in st.session_state:
-    st.session_state.source_analysis = ""
-if "generated_question" not in st.session_state:
-    st.session_state.generated_question = ""
-if "locked_question" not in st.session_state:
-    st.session_state.locked_question = ""
-if "generated_answer" not in st.session_state:
-    st.session_state.generated_answer = ""
-if "question_locked" not in st.session_state:
-    st.session_state.question_locked = False
-if "question_editor" not in st.session_state:
-    st.session_state.question_editor = ""
-if "answer_editor" not in st.session_state:
-    st.session_state.answer_editor = ""
-if "question_field" not in st.session_state:
-    st.session_state.question_field = "法律/金融/资本市场/证券与上市(IPO)"
-if "chinese_characteristics" not in st.session_state:
-    st.session_state.chinese_characteristics = "是"
-if "question_detected" not in st.session_state:
-    st.session_state.question_detected = False
-if "detection_result" not in st.session_state:
-    st.session_state.detection_result = ""
-if "processed_file_name" not in st.session_state:
-    st.session_state.processed_file_name = ""
+def is_api_error(result: str):
+    """判断返回文本是否为错误提示"""
+    return not result or result.startswith("❌")
 
 # ==========================================
-# 文件保存函数
+# 长文本检索（答案生成）
 # ==========================================
-def save_to_file(source_text: str, question: str, answer: str):
-    """保存数据到 Auto 文件夹"""
-    try:
-        # 确保 Auto 文件夹存在
-        auto_dir = Path(__file__).parent  # Auto 文件夹
-        auto_dir.mkdir(exist_ok=True)
-        
-        # 生成文件名（使用时间戳）
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"legal_data_{timestamp}.json"
-        filepath = auto_dir / filename
-        
-        # 构建数据字典
-        data = {
-            "timestamp": timestamp,
-            "source_text": source_text,
-            "question": question,
-            "answer": answer,
-            "question_field": st.session_state.question_field,
-            "chinese_characteristics": st.session_state.chinese_characteristics,
-            "created_at": datetime.now().isoformat()
-        }
-        
-        # 保存为 JSON
-        with open(filepath, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        
-        return filepath, None
-    except Exception as e:
-        return None, str(e)
+# 案件文本超出答案生成的 token 上限时，不再只保留开头部分，
+# 而是按 token 切块后检索与题目最相关的若干块（按原文顺序拼接）作为上下文
+RETRIEVAL_CHUNK_TOKENS = 400
+RETRIEVAL_CHUNK_OVERLAP = 50
+# 检索结果中各块之间的分隔符（计入 token 预算）
+RETRIEVAL_SEPARATOR = "\n……\n"
+# 已安装 sentence-transformers 时使用的多语言向量模型；未安装时使用字符二元组 TF-IDF
+RETRIEVAL_EMBEDDING_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
 
-# ==========================================
-# 模块 1：原始案件处理模块
-# ==========================================
-st.markdown('<div class="section-header">1. 原始案件素材</div>', unsafe_allow_html=True)
+@st.cache_resource(show_spinner=False)
+def _sentence_encoder():
+    """延迟加载 sentence-transformers 向量模型，未安装或加载失败时返回 None"""
+    try:
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(RETRIEVAL_EMBEDDING_MODEL)
+    except Exception:
+        return None
 
-st.markdown("""
-**说明：** 请选择您深度完成过的工作（如论文、研究报告、课程作业、项目描述等）。
-题目应该专业、真实、信息完整，有详细的要求和示例。
-""")
+def split_by_tokens(text: str, chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS,
+                    overlap: int = RETRIEVAL_CHUNK_OVERLAP):
+    """按 token 数将文本切分为相互重叠的块（按字符偏移切分，不会切断多 token 的汉字）"""
+    step = chunk_tokens - overlap
+    encoder = _token_encoder()
+    if encoder is None:
+        chunk_chars = chunk_tokens // FALLBACK_TOKENS_PER_CHAR
+        step_chars = step // FALLBACK_TOKENS_PER_CHAR
+        overlap_chars = overlap // FALLBACK_TOKENS_PER_CHAR
+        return [
+            text[start:start + chunk_chars]
+            for start in range(0, max(len(text) - overlap_chars, 1), step_chars)
+        ]
+    
+    _, offsets = encoder.decode_with_offsets(encoder.encode(text))
+    offsets.append(len(text))
+    return [
+        text[offsets[start]:offsets[min(start + chunk_tokens, len(offsets) - 1)]]
+        for start in range(0, max(len(offsets) - 1 - overlap, 1), step)
+    ]
 
-col1, col2 = st.columns([3, 1])
+def _char_bigrams(text: str):
+    """统计文本的字符二元组（忽略空白字符）"""
+    text = "".join(text.split())
+    counts = {}
+    for i in range(len(text) - 1):
+        bigram = text[i:i + 2]
+        counts[bigram] = counts.get(bigram, 0) + 1
+    return counts
 
-with col1:
-    st.markdown('<div class="field-label">* 原始案件文本</div>', unsafe_allow_html=True)
-    
-    # 文件上传功能（放在 text_area 之前，确保文件上传后能正确更新）
-    uploaded_file = st.file_uploader(
-        "或上传文本文件",
-        type=["txt", "md", "docx", "pdf"],
-        help="支持上传 .txt、.md、.docx 或 .pdf 文件",
-        label_visibility="collapsed"
-    )
+def _tfidf_index(texts):
+    """
+    计算字符二元组 TF-IDF 稀疏向量
     
-    # 处理文件上传（避免重复处理导致无限循环）
-    if uploaded_file is not None:
-        # 检查是否已经处理过这个文件
-        current_file_name = uploaded_file.name
-        if current_file_name != st.session_state.processed_file_name:
-            try:
-                file_extension = current_file_name.split('.')[-1].lower()
-                extracted_text = ""
-                
-                if file_extension == 'pdf':
-                    # PDF 文件处理
-                    try:
-                        import pdfplumber
-                        # 将文件指针重置到开头
-                        uploaded_file.seek(0)
-                        pdf_text = []
-                        with pdfplumber.open(uploaded_file) as pdf:
-                            for page in pdf.pages:
-                                text = page.extract_text()
-                                if text:
-                                    pdf_text.append(text)
-                        extracted_text = "\n\n".join(pdf_text)
-                        if not extracted_text.strip():
-                            st.warning("⚠️ PDF 文件似乎没有可提取的文本内容，可能是扫描版图片。")
-                    except ImportError:
-                        st.error("❌ 请安装 pdfplumber 库以支持 PDF 文件：pip install pdfplumber")
-                        extracted_text = ""
-                    except Exception as e:
-                        st.error(f"❌ PDF 文件读取失败：{str(e)}")
-                        extracted_text = ""
-                
-                elif file_extension == 'docx':
-                    # Word 文档处理
-                    try:
-                        from docx import Document
-                        doc = Document(uploaded_file)
-                        extracted_text = "\n".join([para.text for para in doc.paragraphs])
-                    except ImportError:
-                        st.warning("⚠️ 请安装 python-docx 库以支持 .docx 文件：pip install python-docx")
-                        extracted_text = uploaded_file.read().decode("utf-8", errors="ignore")
-                    except Exception as e:
-                        st.error(f"❌ Word 文档读取失败：{str(e)}")
-                        extracted_text = ""
-                
-                else:
-                    # 文本文件处理（txt, md 等）
-                    extracted_text = uploaded_file.read().decode("utf-8")
-                
-                if extracted_text.strip():
-                    st.session_state.source_text = extracted_text
-                    st.session_state.processed_file_name = current_file_name  # 标记已处理
-                    st.success(f"✅ 文件 '{current_file_name}' 已成功加载（共 {len(extracted_text)} 字符）")
-                    # 使用 st.rerun() 但只执行一次
-                    st.rerun()
-                else:
-                    st.warning("⚠️ 文件内容为空，请检查文件格式是否正确。")
-                    
-            except Exception as e:
-                st.error(f"❌ 文件读取失败：{str(e)}")
-        # 如果文件已处理过，不再重复处理（避免无限循环）
-    # 注意：不要在没有上传文件时清除 processed_file_name，因为 rerun 后 uploaded_file 会暂时为 None
-    # 只有在用户明确删除文件（通过文件上传器的 X 按钮）时，processed_file_name 才会自然失效
-    
-    # 文本输入框（使用 session_state 的值，确保文件上传后能正确显示）
-    # 使用固定的 key，避免因 key 变化导致数据丢失
-    source_input = st.text_area(
-        "案件文本",
-        value=st.session_state.source_text,
-        height=250,
-        placeholder="请在此输入或粘贴原始判决文本、案件描述等...",
-        help="支持直接输入文本或从文件复制粘贴",
-        label_visibility="collapsed",
-        key="source_text_area"
-    )
+    每块只保存自身出现的二元组权重（dict），不构造 块数 × 词表 的稠密矩阵
     
-    # 同步文本框的值到 session_state
-    # 重要：保护已有数据，避免意外清空
-    # 如果 source_text 已有内容，只有在以下情况才更新：
-    # 1. 用户手动输入了新内容（新内容明显不同）
-    # 2. 或者 source_text 为空
-    if source_input != st.session_state.source_text:
-        # 如果 source_text 已有内容，需要谨慎判断是否是用户的新输入
-        if not st.session_state.source_text:
-            # source_text 为空，直接更新
-            st.session_state.source_text = source_input
-        elif source_input.strip() and len(source_input) > 50:
-            # 如果新输入有内容且足够长，可能是用户的新输入，更新
-            # 但保留 processed_file_name，表示可能来自文件
-            st.session_state.source_text = source_input
+    Returns:
+        (各块的 {二元组: 权重}, 各块向量的 L2 范数, {二元组: idf})
+    """
+    counts = [_char_bigrams(text) for text in texts]
+    document_freq = {}
+    for doc_counts in counts:
+        for bigram in doc_counts:
+            document_freq[bigram] = document_freq.get(bigram, 0) + 1
+    idf = {
+        bigram: math.log((1 + len(texts)) / (1 + freq)) + 1
+        for bigram, freq in document_freq.items()
+    }
+    rows = [{bigram: count * idf[bigram] for bigram, count in doc_counts.items()} for doc_counts in counts]
+    norms = [math.sqrt(sum(weight * weight for weight in row.values())) or 1.0 for row in rows]
+    return rows, norms, idf
 
-with col2:
-    st.markdown('<div class="field-label">操作</div>', unsafe_allow_html=True)
-    analyze_btn = st.button(
-        "🔍 分析案件",
-        type="primary",
-        use_container_width=True,
-        disabled=not st.session_state.source_text.strip()
-    )
-    
-    if analyze_btn and st.session_state.source_text.strip():
-        with st.spinner("正在调用 DeepSeek API 进行分析..."):
-            analysis_result = analyze_source_text(st.session_state.source_text)
-            st.session_state.source_analysis = analysis_result
-            st.session_state.question_detected = True
-            st.session_state.detection_result = analysis_result
-        st.rerun()
+def _tfidf_scores(query: str, index):
+    """计算 query 与各块的余弦相似度（只遍历 query 中出现的二元组；query 范数不影响排序，省略）"""
+    query_weights = {
+        bigram: count * index["idf"][bigram]
+        for bigram, count in _char_bigrams(query).items()
+        if bigram in index["idf"]
+    }
+    return np.asarray([
+        sum(weight * row.get(bigram, 0.0) for bigram, weight in query_weights.items()) / norm
+        for row, norm in zip(index["rows"], index["norms"])
+    ])
 
-# 显示分析结果（放在模块1下方，确保能正确显示）
-st.markdown("")  # 添加一些间距
-if st.session_state.source_analysis:
-    st.markdown('<div class="field-label">※ 案件分析结果</div>', unsafe_allow_html=True)
-    
-    analysis_text = st.session_state.source_analysis
-    analysis_upper = analysis_text.upper()
-    
-    # 判断是否通过（检查 YES 或 通过 关键词）
-    is_passed = "YES" in analysis_upper or "通过" in analysis_text or "≥6" in analysis_text or "总分" in analysis_text
-    
-    if is_passed:
-        st.markdown("""
-        <div class="detection-pass">
-            <strong>✅ 检测通过</strong><br>
-            {}
-        </div>
-        """.format(analysis_text.replace("\n", "<br>").replace(" ", "&nbsp;")), unsafe_allow_html=True)
+@st.cache_resource(show_spinner=False, max_entries=8)
+def build_retrieval_index(source_text: str):
+    """对案件文本切块并向量化（按文本内容缓存，rerun 与后续检索无需重复计算）"""
+    chunks = split_by_tokens(source_text)
+    index = {"chunks": chunks, "chunk_tokens": [count_tokens(chunk) for chunk in chunks]}
+    encoder = _sentence_encoder()
+    if encoder is not None:
+        index["matrix"] = encoder.encode(chunks, normalize_embeddings=True)
     else:
-        st.markdown("""
-        <div class="detection-fail">
-            <strong>⚠️ 检测未通过</strong><br>
-            {}<br>
-            <small>提示：请检查案件复杂度是否符合要求（总分需≥6分）</small>
-        </div>
-        """.format(analysis_text.replace("\n", "<br>").replace(" ", "&nbsp;")), unsafe_allow_html=True)
+        index["rows"], index["norms"], index["idf"] = _tfidf_index(chunks)
+    return index
+
+def retrieve_context(query: str, source_text: str, max_tokens: int) -> str:
+    """检索与 query 最相关的文本块，在 max_tokens 以内（含分隔符）按原文顺序拼接返回"""
+    index = build_retrieval_index(source_text)
+    if "matrix" in index:
+        scores = index["matrix"] @ _sentence_encoder().encode([query], normalize_embeddings=True)[0]
+    else:
+        scores = _tfidf_scores(query, index)
     
-    # 同时用普通 markdown 显示，确保内容可见
-    with st.expander("📋 查看详细分析结果", expanded=True):
-        st.markdown(analysis_text)
+    separator_tokens = count_tokens(RETRIEVAL_SEPARATOR)
+    selected = []
+    used = 0
+    for i in np.argsort(-scores):
+        chunk_tokens = index["chunk_tokens"][i] + (separator_tokens if selected else 0)
+        if used + chunk_tokens > max_tokens:
+            break
+        selected.append(i)
+        used += chunk_tokens
+    return RETRIEVAL_SEPARATOR.join(index["chunks"][i] for i in sorted(selected))
 
 # ==========================================
-# 模块 2：题目构建模块
+# API 响应缓存
 # ==========================================
-st.markdown('<div class="section-header">2. 题目构建</div>', unsafe_allow_html=True)
+# 两级精确缓存：进程内 LRU 字典（微秒级）+ .cache 目录下的 SQLite（跨进程、重启后仍有效）。
+# 流式输出需在调用过程中渲染占位符，无法放入 st.cache_data 函数体，
+# 因此由 st.cache_resource 持有缓存对象，由调用方显式读写
+CACHE_DIR = Path(__file__).parent / ".cache"
+RESPONSE_CACHE_TTL = 24 * 3600
+RESPONSE_CACHE_MAX_ENTRIES = 256
+RESPONSE_DISK_CACHE_MAX_ENTRIES = 4096
+# 本地缓存文件（响应缓存、PDF 解析结果、会话检查点）两次过期清理之间的最短间隔（秒）
+CACHE_PRUNE_INTERVAL = 3600
 
-if not st.session_state.source_text:
-    st.warning("⚠️ 请先完成步骤 1：输入原始案件素材")
-else:
-    # 题目领域选择
-    st.markdown('<div class="field-label">* 题目领域</div>', unsafe_allow_html=True)
-    field_options = [
-        "法律/金融/资本市场/证券与上市(IPO)",
-        "法律/刑法/刑事案例分析",
-        "法律/民法/合同纠纷",
-        "法律/公司法/企业合规",
-        "金融/投资分析",
-        "金融/风险管理",
-        "医疗/临床诊断",
-        "医疗/治疗方案",
-        "科研/实验设计",
-        "其他专业领域"
-    ]
-    
-    selected_field = st.selectbox(
-        "选择题目领域",
-        options=field_options,
-        index=field_options.index(st.session_state.question_field) if st.session_state.question_field in field_options else 0,
-        label_visibility="collapsed"
-    )
-    st.session_state.question_field = selected_field
+# 本地缓存文件中包含判决原文：目录仅对当前用户可访问（0700），文件创建时即为 0600
+def ensure_private_dir(directory: Path):
+    """创建仅当前用户可访问的目录（已存在的目录同样收紧为 0700）"""
+    directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(directory, 0o700)
+
+def write_private_file(path: Path, data: bytes):
+    """写入仅当前用户可读写的文件：先写 0600 的临时文件再替换，中途出错或并发读取时不会看到写了一半的文件"""
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def prune_stale_files(directory: Path, pattern: str, ttl: float, max_bytes: int = None):
+    """
+    清理 directory 下匹配 pattern 的过期文件
     
-    # 显示领域可用状态
-    col1, col2 = st.columns([1, 4])
-    with col1:
-        st.success("✅ 领域可用")
-    
-    # 中国特色
-    st.markdown('<div class="field-label">* 中国特色</div>', unsafe_allow_html=True)
-    chinese_char = st.radio(
-        "是否具有中国特色",
-        options=["是", "否"],
-        index=0 if st.session_state.chinese_characteristics == "是" else 1,
-        horizontal=True,
-        help="中国特色指深度依赖本土中国文化的题目，如中国政策、中国法律、中医等",
-        label_visibility="collapsed"
+    Args:
+        directory: 缓存目录
+        pattern: 文件名匹配模式
+        ttl: 超过该时长（秒）未更新的文件直接删除
+        max_bytes: 剩余文件的总大小上限，超出时从最久未更新的文件开始删除；None 表示不限制
+    """
+    expire_before = time.time() - ttl
+    kept = []
+    for path in directory.glob(pattern):
+        try:
+            stat = path.stat()
+            if stat.st_mtime < expire_before:
+                path.unlink()
+            else:
+                kept.append((stat.st_mtime, stat.st_size, path))
+        except OSError:
+            continue
+    if max_bytes is None:
+        return
+    total = sum(size for _, size, _ in kept)
+    for _, size, path in sorted(kept):
+        if total <= max_bytes:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+
+@st.cache_resource(show_spinner=False)
+def _response_cache():
+    """进程内共享的响应缓存：entries 为按最近使用排序的 {key: (写入时间, 文本)}"""
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+@st.cache_resource(show_spinner=False)
+def _response_db():
+    """打开 SQLite 响应缓存，目录不可写时返回 None（仅使用进程内缓存）"""
+    try:
+        ensure_private_dir(CACHE_DIR)
+        db_path = CACHE_DIR / "responses.sqlite3"
+        # 先以 0600 创建数据库文件（SQLite 的日志文件沿用数据库文件的权限），已存在的文件同样收紧
+        os.close(os.open(db_path, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(db_path, 0o600)
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, created_at REAL NOT NULL, text TEXT NOT NULL)"
+        )
+        conn.commit()
+    except (OSError, sqlite3.Error):
+        return None
+    return conn
+
+def response_cache_key(*parts) -> str:
+    """由若干输入部分计算缓存键"""
+    joined = "\0".join(str(part) for part in parts)
+    return hashlib.blake2b(joined.encode("utf-8"), digest_size=16).hexdigest()
+
+def request_cache_key(prompt: str, system_prompt: str, temperature: float, max_tokens: int = None,
+                      model: str = None):
+    """单次 API 请求的缓存键：(模型, 系统提示词, 用户提示词, 温度, 输出上限)"""
+    return response_cache_key("request", model or model_name, system_prompt, prompt, round(temperature, 2),
+                              max_tokens)
+
+def get_cached_response(key: str):
+    """读取未过期的缓存结果（先查进程内缓存，再查 SQLite），未命中时返回 None"""
+    cache = _response_cache()
+    with cache["lock"]:
+        item = cache["entries"].get(key)
+        if item is not None:
+            stored_at, text = item
+            if time.time() - stored_at <= RESPONSE_CACHE_TTL:
+                cache["entries"].move_to_end(key)
+                return text
+            del cache["entries"][key]
+        
+        conn = _response_db()
+        if conn is None:
+            return None
+        try:
+            row = conn.execute(
+                "SELECT created_at, text FROM responses WHERE key = ? AND created_at >= ?",
+                (key, time.time() - RESPONSE_CACHE_TTL)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        cache["entries"][key] = row
+        while len(cache["entries"]) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache["entries"].popitem(last=False)
+        return row[1]
+
+def store_cached_response(key: str, text: str):
+    """写入缓存结果（错误提示不缓存），超出容量时淘汰最早写入的条目"""
+    if is_api_error(text):
+        return
+    now = time.time()
+    cache = _response_cache()
+    with cache["lock"]:
+        cache["entries"][key] = (now, text)
+        cache["entries"].move_to_end(key)
+        while len(cache["entries"]) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache["entries"].popitem(last=False)
+        
+        conn = _response_db()
+        if conn is None:
+            return
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, now, text))
+                conn.execute(
+                    "DELETE FROM responses WHERE created_at < ? OR key NOT IN "
+                    "(SELECT key FROM responses ORDER BY created_at DESC LIMIT ?)",
+                    (now - RESPONSE_CACHE_TTL, RESPONSE_DISK_CACHE_MAX_ENTRIES)
+                )
+        except sqlite3.Error:
+            pass
+
+def analysis_cache_key(source_text: str):
+    """案件分析结果的缓存键"""
+    return response_cache_key("analysis", ANALYZE_PROMPT_VERSION, model_name, source_text)
+
+def question_cache_key(source_text: str):
+    """题目生成结果的缓存键"""
+    return response_cache_key("question", QUESTION_PROMPT_VERSION, model_name, source_text)
+
+def lookup_result(source_text: str, kind: str):
+    """依次查找近似重复缓存与精确缓存，未命中时返回 None"""
+    cached = find_near_duplicate(source_text, kind)
+    if cached is None:
+        key = analysis_cache_key(source_text) if kind == "analysis" else question_cache_key(source_text)
+        cached = get_cached_response(key)
+    return cached
+
+def record_result(source_text: str, kind: str, result: str):
+    """将 API 结果写入精确缓存与近似重复缓存"""
+    key = analysis_cache_key(source_text) if kind == "analysis" else question_cache_key(source_text)
+    store_cached_response(key, result)
+    remember_result(source_text, kind, result)
+
+# ==========================================
+# 近似重复文本缓存（MinHash）
+# ==========================================
+# 用户常重复上传略有改动的同一份判决（空白、页眉差异等），
+# 字符 5-gram 的 Jaccard 相似度达到阈值时直接复用已有的分析结果/题目。
+# 索引在进程内跨会话共享，超出容量时淘汰最早登记的文本
+NEAR_DUP_THRESHOLD = 0.9
+NEAR_DUP_NUM_PERM = 64
+NEAR_DUP_SHINGLE_SIZE = 5
+NEAR_DUP_MAX_ENTRIES = 1024
+
+@st.cache_resource(show_spinner=False)
+def _datasketch():
+    """延迟导入 datasketch，未安装时返回 None（不启用近似重复缓存）"""
+    try:
+        import datasketch
+    except ImportError:
+        return None
+    return datasketch
+
+def source_minhash(source_text: str):
+    """计算文本字符 5-gram 的 MinHash（忽略空白字符差异）"""
+    text = "".join(source_text.split())
+    minhash = _datasketch().MinHash(num_perm=NEAR_DUP_NUM_PERM)
+    minhash.update_batch(
+        text[i:i + NEAR_DUP_SHINGLE_SIZE].encode("utf-8")
+        for i in range(max(len(text) - NEAR_DUP_SHINGLE_SIZE + 1, 1))
     )
-    st.session_state.chinese_characteristics = chinese_char
-    
-    # 题目内容
-    st.markdown('<div class="field-label">* 题目内容</div>', unsafe_allow_html=True)
+    return minhash
+
+@st.cache_resource(show_spinner=False)
+def _near_dup_store():
+    """获取进程内共享的 MinHash LSH 索引及其缓存结果"""
+    return {
+        "lock": threading.Lock(),
+        "lsh": _datasketch().MinHashLSH(threshold=NEAR_DUP_THRESHOLD, num_perm=NEAR_DUP_NUM_PERM),
+        "entries": {}
+    }
+
+def _near_dup_field(kind: str):
+    """近似重复缓存中结果的字段名（区分模型与提示词版本）"""
+    version = ANALYZE_PROMPT_VERSION if kind == "analysis" else QUESTION_PROMPT_VERSION
+    return f"{kind}:{version}:{model_name}"
+
+def find_near_duplicate(source_text: str, kind: str):
+    """
+    查找近似重复文本的已缓存结果
     
-    # 在创建组件之前，先处理生成题目的逻辑
-    generate_question_btn = st.button(
-        "🚀 生成题目",
-        type="primary",
-        key="generate_question_btn",
-        disabled=not st.session_state.source_text
-    )
+    Args:
+        source_text: 原始案件文本
+        kind: 结果类型（"analysis" 或 "question"）
     
-    # 生成题目（在创建组件之前处理）
-    if generate_question_btn:
-        # 确保 source_text 存在且不为空
-        if not st.session_state.source_text or not st.session_state.source_text.strip():
-            st.error("❌ 错误：原始案件文本为空，请先完成模块1：输入原始案件素材")
-        else:
-            with st.spinner("正在调用 DeepSeek API 生成题目..."):
-                try:
-                    generated = generate_question(st.session_state.source_text)
-                    if generated and generated.strip():
-                        # 确保在更新前，source_text 仍然存在（防止在生成过程中被清空）
-                        if st.session_state.source_text:
+    Returns:
+        命中时返回缓存的结果文本，否则返回 None
+    """
+    if _datasketch() is None:
+        return None
+    store = _near_dup_store()
+    field = _near_dup_field(kind)
+    minhash = source_minhash(source_text)
+    with store["lock"]:
+        for key in store["lsh"].query(minhash):
+            entry = store["entries"][key]
+            if field in entry and entry["minhash"].jaccard(minhash) >= NEAR_DUP_THRESHOLD:
+                return entry[field]
+    return None
+
+def remember_result(source_text: str, kind: str, result: str):
+    """将 API 结果登记到近似重复缓存（错误提示和本地预检结论不登记）"""
+    if _datasketch() is None or is_api_error(result) or result == PREFILTER_REJECTION:
+        return
+    store = _near_dup_store()
+    key = hashlib.blake2b(source_text.encode("utf-8"), digest_size=16).hexdigest()
+    with store["lock"]:
+        entry = store["entries"].get(key)
+        if entry is None:
+            if len(store["entries"]) >= NEAR_DUP_MAX_ENTRIES:
+                oldest_key = next(iter(store["entries"]))
+                store["lsh"].remove(oldest_key)
+                del store["entries"][oldest_key]
+            minhash = source_minhash(source_text)
+            store["lsh"].insert(key, minhash)
+            entry = store["entries"][key] = {"minhash": minhash}
+        entry[_near_dup_field(kind)] = result
+
+# 提示词版本号：修改对应的系统提示词后需递增，使旧的缓存结果失效
+ANALYZE_PROMPT_VERSION = "v3"
+QUESTION_PROMPT_VERSION = "v2"
+
+ANALYZE_SYSTEM_PROMPT = """你是一位法律大模型基准测试（Benchmark）的数据专家。我正在构建一个用于测评 Legal LLM 的数据集，核心考察维度为复杂案情分析能力（特别是多罪名认定）和外部知识库检索（RAG）能力。
+请审核以下[待测案件]，并根据下列标准进行 1-5 分的打分：
+1. 多罪名分析维度：
+5分：案情复杂，涉及两个及以上罪名，且罪名之间存在竞合、牵连关系或事实交叉，需要极强的逻辑拆解能力（例如：既涉嫌诈骗又涉嫌非法吸收公众存款）。
+3分：涉及多个罪名，但各罪名事实独立，界限清晰，推理难度一般。
+1分：单一罪名或案情极其简单。
+2. 检索依赖维度：
+5分：必须检索特定的地方法规、行业规范、司法解释或复杂的过往判例才能做出准确判断（仅凭通用法律常识无法回答）。
+3分：需要引用具体的刑法条款，但属于常见条款。
+1分：仅凭常识或基础法理即可回答，无需外部检索。
+输出要求： 【YES / NO】（总分≥6分）"""
+
+# 案件分析是评分而非创作：温度为 0 使结果稳定可复现，并限制输出长度以控制最长耗时
+ANALYZE_TEMPERATURE = 0.0
+ANALYZE_MAX_TOKENS = 1500
+
+def build_analyze_request(source_text: str):
+    """构建分析原始判决文本的请求（仅用于不超过 MAP_REDUCE_THRESHOLD_TOKENS 的文本，超长文本见 map_reduce_analyze）"""
+    prompt = f"请分析以下判决文本：\n\n{source_text}"
+    return prompt, ANALYZE_SYSTEM_PROMPT, ANALYZE_TEMPERATURE, ANALYZE_MAX_TOKENS
+
+def build_chunk_analyze_request(chunk: str, index: int, total: int):
+    """构建分析长文本中单个分块的请求（map 阶段）"""
+    # 固定的说明放在前面、分块编号和内容放在最后，各分块请求共享尽可能长的相同前缀（便于服务端前缀缓存）
+    prompt = f"""以下是一份较长判决文本中的一部分。请仅根据本部分内容，列出涉及的罪名及其关系、需要检索的法律依据，并按评分标准给出两个维度的初步评分：
+
+【第 {index}/{total} 部分】
+{chunk}"""
+    return prompt, ANALYZE_SYSTEM_PROMPT, ANALYZE_TEMPERATURE, ANALYZE_MAX_TOKENS
+
+def build_reduce_analyze_request(chunk_analyses):
+    """构建汇总各分块分析结果的请求（reduce 阶段）"""
+    joined = "\n\n".join(
+        f"【第 {i} 部分分析】\n{analysis}" for i, analysis in enumerate(chunk_analyses, start=1)
+    )
+    prompt = f"""以下是对同一份判决文本各部分的分析结果。请综合全部内容，对整个案件按评分标准给出两个维度的最终评分及总分，并输出结论：
+
+{joined}"""
+    return prompt, ANALYZE_SYSTEM_PROMPT, ANALYZE_TEMPERATURE, ANALYZE_MAX_TOKENS
+
+def map_reduce_analyze(source_text: str, model: str = None, stream_placeholder=None):
+    """分块并发分析长判决文本，再汇总为最终结论（出错时抛出异常；汇总阶段可流式显示）"""
+    sentences = split_sentences(source_text)
+    max_sentences = CHUNK_SENTENCES
+    while True:
+        chunks = chunk_sentences(sentences, max_sentences)
+        # 分块分析阶段不流式输出，可能持续数十秒：先在占位符中显示进度提示，汇总阶段开始输出时被替换
+        if stream_placeholder is not None:
+            stream_placeholder.info(f"⏳ 文本较长，正在分 {len(chunks)} 段并行分析，完成后汇总结论...")
+        results = gather_completions(
+            [build_chunk_analyze_request(chunk, i, len(chunks)) for i, chunk in enumerate(chunks, start=1)],
+            request_timeout=ANALYZE_TIMEOUT,
+            model=model
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if not errors:
+            break
+        # 分块仍超出上下文长度时缩小分块后重试
+        if max_sentences > CHUNK_SENTENCES_STEP and any(is_context_length_error(e) for e in errors):
+            max_sentences -= CHUNK_SENTENCES_STEP
+            continue
+        raise errors[0]
+    
+    reduce_request = build_reduce_analyze_request(results)
+    if stream_placeholder is not None:
+        return stream_completion(*reduce_request, stream_placeholder, request_timeout=ANALYZE_TIMEOUT, model=model)
+    return request_completion(*reduce_request, model=model, request_timeout=ANALYZE_TIMEOUT)
+
+# 本地预检：文本过短或法律关键词过少的案件直接判定不通过，不调用 API
+PREFILTER_MIN_CHARS = 500
+PREFILTER_MIN_KEYWORDS = 3
+PREFILTER_REJECTION = "NO（本地预检：案情过简或法律关键词不足，未调用 API）"
+# 法律关键词（中英文判决均适用），单次扫描统计命中的不同关键词数
+_LEGAL_KEYWORD_RE = re.compile(
+    r"罪|判决|上诉|条|款|解释|offen[cs]e|judgment|appeal|section|statute|court",
+    re.IGNORECASE
+)
+
+def keyword_hit_count(text: str, limit: int = None):
+    """统计文本中命中的不同法律关键词数（达到 limit 后提前结束扫描）"""
+    hits = set()
+    for match in _LEGAL_KEYWORD_RE.finditer(text):
+        hits.add(match.group(0).lower())
+        if limit and len(hits) >= limit:
+            break
+    return len(hits)
+
+def passes_local_prefilter(source_text: str):
+    """判断文本是否值得调用 API 进行分析"""
+    return (
+        len(source_text) >= PREFILTER_MIN_CHARS
+        and keyword_hit_count(source_text, limit=PREFILTER_MIN_KEYWORDS) >= PREFILTER_MIN_KEYWORDS
+    )
+
+def needs_map_reduce(source_text: str) -> bool:
+    """判断文本是否超出单次分析请求的 token 上限（需分块分析后汇总）"""
+    return count_tokens(source_text) > MAP_REDUCE_THRESHOLD_TOKENS
+
+def analyze_long_text(source_text: str, stream_placeholder=None):
+    """分块分析超长判决文本，并将异常转换为错误提示"""
+    api_key_value, _ = resolve_api_config()
+    if not api_key_value:
+        return "❌ 错误：未配置 API Key，请在侧边栏输入"
+    try:
+        return map_reduce_analyze(source_text, stream_placeholder=stream_placeholder)
+    except Exception as e:
+        return format_api_error(e)
+
+def analyze_with_prefilter(source_texts, analyze_many):
+    """
+    批量分析的公共入口：未通过本地预检的文本直接返回预检结论，
+    超长文本逐个分块分析，其余文本交给 analyze_many 批量分析
+    """
+    results = [None if passes_local_prefilter(text) else PREFILTER_REJECTION for text in source_texts]
+    pending = []
+    for i, result in enumerate(results):
+        if result is None:
+            if needs_map_reduce(source_texts[i]):
+                results[i] = analyze_long_text(source_texts[i])
+            else:
+                pending.append(i)
+    if pending:
+        for i, result in zip(pending, analyze_many([source_texts[i] for i in pending])):
+            results[i] = result
+    return results
+
+def analyze_source_text(source_text: str, stream_placeholder=None):
+    """分析原始判决文本（命中缓存时直接返回，否则调用 API，可流式显示）"""
+    if not passes_local_prefilter(source_text):
+        return PREFILTER_REJECTION
+    cached = lookup_result(source_text, "analysis")
+    if cached is not None:
+        return cached
+    
+    if needs_map_reduce(source_text):
+        result = analyze_long_text(source_text, stream_placeholder=stream_placeholder)
+    else:
+        result = call_deepseek_api(*build_analyze_request(source_text), request_timeout=ANALYZE_TIMEOUT,
+                                   stream_placeholder=stream_placeholder, use_cache=False)
+    record_result(source_text, "analysis", result)
+    return result
+
+# 分析结果通过判定关键词（单次扫描，忽略大小写，无需 .upper() 复制全文）
+_PASS_RE = re.compile(r"YES|通过|≥6|总分", re.IGNORECASE)
+
+def is_analysis_passed(analysis_text: str) -> bool:
+    """判断案件分析结果是否通过（错误提示与本地预检结论视为未通过）"""
+    if is_api_error(analysis_text) or analysis_text == PREFILTER_REJECTION:
+        return False
+    return bool(_PASS_RE.search(analysis_text))
+
+# 分析结论：系统提示词要求输出【YES / NO】；先去掉原样复述的 "YES / NO"，再取最后出现的独立 YES 或 NO
+_VERDICT_ECHO_RE = re.compile(r"YES\s*/\s*NO")
+_VERDICT_RE = re.compile(r"(?<![A-Za-z])(YES|NO)(?![A-Za-z])")
+
+def parse_analysis_verdict(analysis_text: str):
+    """
+    解析案件分析结果中的【YES/NO】结论
+    
+    Returns:
+        True/False；错误提示或找不到结论时返回 None
+    """
+    if is_api_error(analysis_text):
+        return None
+    matches = _VERDICT_RE.findall(_VERDICT_ECHO_RE.sub("", analysis_text))
+    if not matches:
+        return None
+    return matches[-1] == "YES"
+
+# 批量结果表中「是否通过」列的显示（无法判断时提示人工查看）
+VERDICT_LABELS = {True: "✅", False: "❌", None: "⚠️"}
+
+def analyze_sources_concurrently(source_texts):
+    """并发分析多份原始判决文本"""
+    return analyze_with_prefilter(
+        source_texts,
+        lambda texts: run_many([build_analyze_request(text) for text in texts], request_timeout=ANALYZE_TIMEOUT)
+    )
+
+QUESTION_SYSTEM_PROMPT = """Role: 你是一位资深的法律人工智能专家，专门负责构建高难度的 Legal LLM（法律大语言模型）评测数据集。你擅长将原始案例转化为考察模型"深度逻辑推理"与"知识检索精准度"的复杂题目。  
+Task: 请参考提供的示例，对案情素材进行二次加工，构造出一个高质量的法律测评问题及其配套的"题目评价"。  
+核心考察维度（必须在题目中体现）,同时注意避免AI味过重：  
+复杂案情分析能力： 侧重多罪名认定、罪名交叉、罪数形态（自首、立功、并罚等）的判定。  
+RAG 能力测试点： 题目须要求模型必须结合特定的外部法律条文、司法解释或行业规则（如香港上市规则、刑法特定章节）进行回答。  
+构造规范：  
+    问题背景： 需包含干扰信息和高度细节化的案情描述，以模拟真实法律文书环境，不要包含法院判决或相关信息。  
+    问题设计： 增强问题难度，针对案件中较难的疑难点进行提问（注意不要太直接的提问），例如准确罪名预测和刑期预测。  
+    问题检测： 评价该题目在法律认知复杂度、区分度以及检索必要性方面的优势。  
+"""
+
+def build_question_request(source_text: str):
+    """构建生成法律题目的请求"""
+    source_text = budget_source_context(source_text, QUESTION_TOKEN_CAP)
+    prompt = f"请根据以下案情生成一道法律题目：\n\n{source_text}"
+    return prompt, QUESTION_SYSTEM_PROMPT, 0.8, None
+
+def generate_question(source_text: str, stream_placeholder=None):
+    """生成法律题目（命中缓存时直接返回，否则调用 API，可流式显示）"""
+    cached = lookup_result(source_text, "question")
+    if cached is not None:
+        return cached
+    result = call_deepseek_api(*build_question_request(source_text), stream_placeholder=stream_placeholder,
+                               use_cache=False)
+    record_result(source_text, "question", result)
+    return result
+
+# 批量生成题目时每次请求合并的案件数；输出超长时改用较小的分组重试
+QUESTION_BULK_SIZE = 10
+QUESTION_BULK_FALLBACK_SIZE = 5
+# 批量生成题目的输出 token 上限：按每个案件预留的 token 数计算，不超过模型允许的最大输出
+QUESTION_OUTPUT_TOKENS_PER_CASE = 800
+MODEL_MAX_OUTPUT_TOKENS = 8192
+# 从模型返回的案件编号中提取数字（兼容 1、"1"、"CASE_1" 等写法）
+_CASE_ID_RE = re.compile(r"\d+")
+
+def build_bulk_question_request(source_texts):
+    """构建一次为多个案件生成题目的请求（系统提示词只发送一次，每个案件文本与单题生成使用相同的 token 上限）"""
+    blocks = "\n\n".join(
+        f"[CASE_{i}]\n{budget_source_context(text, QUESTION_TOKEN_CAP)}"
+        for i, text in enumerate(source_texts, start=1)
+    )
+    prompt = f"""以下是 {len(source_texts)} 个案件素材，分别标注为 [CASE_1] 至 [CASE_{len(source_texts)}]。
+请为每个案件分别生成一道法律题目及其题目评价，并以 JSON 格式输出（id 为案件编号的整数部分，如 [CASE_1] 对应 1）：
+{{"cases": [{{"id": 1, "question": "题目内容", "evaluation": "题目评价"}}]}}
+
+{blocks}"""
+    max_tokens = min(QUESTION_OUTPUT_TOKENS_PER_CASE * len(source_texts), MODEL_MAX_OUTPUT_TOKENS)
+    return prompt, QUESTION_SYSTEM_PROMPT, 0.8, max_tokens
+
+async def _arequest_question_group(client, semaphore, source_texts):
+    """为一组案件请求题目；输出被截断或输入超出上下文长度时返回 None"""
+    try:
+        response = await _acomplete(
+            client, semaphore, *build_bulk_question_request(source_texts),
+            response_format={"type": "json_object"}
+        )
+    except Exception as e:
+        if is_context_length_error(e):
+            return None
+        raise
+    
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        return None
+    
+    by_id = {}
+    for item in orjson.loads(choice.message.content).get("cases", []):
+        if isinstance(item, dict):
+            match = _CASE_ID_RE.search(str(item.get("id", "")))
+            if match:
+                by_id[int(match.group(0))] = item
+    return [
+        {
+            "question": by_id.get(i, {}).get("question", "❌ 题目生成失败：结果缺失"),
+            "evaluation": by_id.get(i, {}).get("evaluation", "")
+        }
+        for i in range(1, len(source_texts) + 1)
+    ]
+
+async def _agenerate_question_group(client, semaphore, group):
+    """为一组案件生成题目；输出超长时拆分为更小的分组并发重试（分组已不大于回退大小时不再重试），出错时返回错误提示"""
+    length_failure = {"question": "❌ 题目生成失败：输出超出长度限制", "evaluation": ""}
+    try:
+        parsed = await _arequest_question_group(client, semaphore, group)
+        if parsed is None and len(group) <= QUESTION_BULK_FALLBACK_SIZE:
+            # 拆分后仍是同一个请求，重试只会重复付费
+            parsed = [length_failure] * len(group)
+        elif parsed is None:
+            sub_groups = [
+                group[sub_start:sub_start + QUESTION_BULK_FALLBACK_SIZE]
+                for sub_start in range(0, len(group), QUESTION_BULK_FALLBACK_SIZE)
+            ]
+            sub_results = await asyncio.gather(
+                *(_arequest_question_group(client, semaphore, sub_group) for sub_group in sub_groups)
+            )
+            parsed = []
+            for sub_group, sub_parsed in zip(sub_groups, sub_results):
+                if sub_parsed is None:
+                    sub_parsed = [length_failure] * len(sub_group)
+                parsed.extend(sub_parsed)
+        return parsed
+    except Exception as e:
+        return [{"question": format_api_error(e), "evaluation": ""}] * len(group)
+
+def generate_questions_bulk(source_texts):
+    """
+    批量生成法律题目：每 QUESTION_BULK_SIZE 个案件合并为一次请求，各分组并发执行
+    
+    Args:
+        source_texts: 案件文本列表
+    
+    Returns:
+        与输入顺序一致的列表，每项为 {"question": ..., "evaluation": ...}
+    """
+    groups = [
+        source_texts[start:start + QUESTION_BULK_SIZE]
+        for start in range(0, len(source_texts), QUESTION_BULK_SIZE)
+    ]
+    try:
+        client = get_async_client()
+    except Exception as e:
+        return [{"question": format_api_error(e), "evaluation": ""}] * len(source_texts)
+    
+    async def _gather():
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        async with client:
+            return await asyncio.gather(
+                *(_agenerate_question_group(client, semaphore, group) for group in groups)
+            )
+    
+    return [item for parsed in asyncio.run(_gather()) for item in parsed]
+
+def analyze_and_generate_question(source_text: str):
+    """并发执行案件分析与题目生成，返回 (分析结果, 题目)"""
+    if passes_local_prefilter(source_text):
+        analysis = lookup_result(source_text, "analysis")
+    else:
+        analysis = PREFILTER_REJECTION
+    question = lookup_result(source_text, "question")
+    
+    # 超长文本的分析需分块进行，不能并入同一批请求
+    if analysis is None and needs_map_reduce(source_text):
+        analysis = analyze_long_text(source_text)
+        record_result(source_text, "analysis", analysis)
+    
+    # 只为未命中缓存的部分发起请求
+    requests = []
+    if analysis is None:
+        requests.append(build_analyze_request(source_text))
+    if question is None:
+        requests.append(build_question_request(source_text))
+    results = iter(run_many(requests) if requests else [])
+    
+    if analysis is None:
+        analysis = next(results)
+        record_result(source_text, "analysis", analysis)
+    if question is None:
+        question = next(results)
+        record_result(source_text, "question", question)
+    return analysis, question
+
+def build_answer_request(question: str, source_text: str):
+    """构建生成解题思路和答案的请求（超长案件文本只保留与题目相关的片段）"""
+    if count_tokens(source_text) > ANSWER_TOKEN_CAP:
+        source_text = retrieve_context(question, source_text, ANSWER_TOKEN_CAP)
+    
+    system_prompt = """你是一位资深的法律教育专家，擅长根据案件详情和题目要求，生成高质量的标准答案和详细的解题思路。
+
+你的任务是：
+1. 仔细阅读并理解PDF文件中的案件详情和背景信息
+2. 根据题目中给出的案件背景，深入分析问题的核心要点
+3. 提供详细的解题思路，包括：
+   - 问题分析：识别题目中的关键法律问题和争议焦点
+   - 法律依据：引用相关的法律条文、司法解释或判例
+   - 推理过程：逐步分析案件的逻辑链条和推理步骤
+   - 结论形成：基于案件事实和法律依据得出最终结论
+4. 给出完整、准确、专业的标准答案
+
+要求：
+- 答案必须基于案件详情，不能脱离案件背景
+- 思考思路要详细、逻辑清晰、条理分明
+- 标准答案要准确、完整、具有权威性
+- 使用专业、规范的法律术语
+- 适当引用法律条文和司法解释作为支撑"""
+    
+    # 固定的结构要求放在前面、题目和案件详情放在最后，不同题目的请求共享尽可能长的相同前缀（便于服务端前缀缓存）
+    prompt = f"""请根据文末人工审核过的题目和案件详情，生成详细的解题思路和标准答案。
+
+请按照以下结构组织你的回答：
+
+## 一、解题思路
+
+### 1. 问题分析
+（识别题目中的关键法律问题、争议焦点等）
+
+### 2. 案件事实梳理
+（从案件详情中提取与题目相关的关键事实）
+
+### 3. 法律依据
+（引用相关的法律条文、司法解释、判例等）
+
+### 4. 推理过程
+（逐步分析案件的逻辑链条，说明如何从事实推导出结论）
+
+### 5. 结论形成
+（基于以上分析，形成最终结论）
+
+## 二、标准答案
+
+（给出完整、准确、专业的标准答案，确保答案基于案件详情，逻辑严密，具有说服力）
+
+【题目和问题】
+{question}
+
+【案件详情（来自PDF文件）】
+{source_text}
+"""
+    return prompt, system_prompt, 0.7, None
+
+def generate_answer(question: str, source_text: str, stream_placeholder=None):
+    """生成解题思路和答案（提供 stream_placeholder 时流式显示）"""
+    return call_deepseek_api(*build_answer_request(question, source_text), stream_placeholder=stream_placeholder)
+
+# ==========================================
+# 答案预生成（锁定题目后在后台推测执行）
+# ==========================================
+@st.cache_resource(show_spinner=False)
+def _prefetch_executor():
+    """后台预生成答案使用的线程池（进程内共享）"""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="answer-prefetch")
+
+def _complete_in_background(client, model: str, prompt: str, system_prompt: str, temperature: float,
+                            max_tokens: int = None):
+    """在后台线程中调用 API（所需对象均由调用方传入，不访问 Streamlit 状态）"""
+    try:
+        response = client.with_options(timeout=GENERATE_TIMEOUT).chat.completions.create(
+            **completion_params(prompt, system_prompt, temperature, max_tokens, model)
+        )
+        return response.choices[0].message.content
+    except Exception as e:
+        return format_api_error(e)
+
+def _answer_prefetch_key(question: str, source_text: str):
+    """预生成答案的匹配键：模型 + 题目 + 案件文本"""
+    digest = hashlib.blake2b(f"{question}\0{source_text}".encode("utf-8"), digest_size=16).hexdigest()
+    return f"{model_name}:{digest}"
+
+def prefetch_answer(question: str, source_text: str):
+    """
+    锁定题目后立即在后台生成答案，利用用户阅读/思考的时间隐藏 API 延迟
+    
+    相同题目已有进行中（或已成功完成）的预生成任务时直接复用；答案已在响应缓存中时不再发起请求
+    """
+    api_key_value, base_url_value = resolve_api_config()
+    if not api_key_value:
+        return
+    key = _answer_prefetch_key(question, source_text)
+    entry = st.session_state.get("_answer_future")
+    if entry and entry["key"] == key:
+        future = entry["future"]
+        if not future.done() or not is_api_error(future.result()):
+            return
+    
+    request = build_answer_request(question, source_text)
+    cache_key = request_cache_key(*request)
+    if get_cached_response(cache_key) is not None:
+        st.session_state.pop("_answer_future", None)
+        return
+    client = get_openai_client(api_key_value, base_url_value)
+    future = _prefetch_executor().submit(_complete_in_background, client, model_name, *request)
+    st.session_state._answer_future = {
+        "key": key,
+        "cache_key": cache_key,
+        "future": future
+    }
+
+def take_prefetched_answer(question: str, source_text: str):
+    """
+    取出与当前题目匹配的预生成答案（仍在生成中则等待完成），不匹配或失败时返回 None
+    
+    成功的结果写入响应缓存，之后再次生成时与 generate_answer 返回同一份答案
+    """
+    entry = st.session_state.pop("_answer_future", None)
+    if not entry or entry["key"] != _answer_prefetch_key(question, source_text):
+        return None
+    result = entry["future"].result()
+    if is_api_error(result):
+        return None
+    store_cached_response(entry["cache_key"], result)
+    return result
+
+# ==========================================
+# 批量处理函数（Batch API）
+# ==========================================
+# 超过该数量的案件走 Batch API（离线、半价），否则走在线并发
+BATCH_MODE_THRESHOLD = 50
+# Batch 任务状态的自动刷新间隔（秒）：任务在后台执行，页面只定时查询一次状态，不阻塞脚本
+BATCH_POLL_INTERVAL = 30
+
+def submit_batch(requests):
+    """
+    将请求序列化为 JSONL 并提交 Batch 任务
+    
+    Args:
+        requests: 请求列表，每项为 (prompt, system_prompt, temperature, max_tokens)
+    
+    Returns:
+        Batch 任务对象
+    """
+    api_key_value, base_url_value = resolve_api_config()
+    if not api_key_value:
+        raise ValueError("未配置 API Key，请在侧边栏输入")
+    client = get_openai_client(api_key_value, base_url_value)
+    
+    lines = []
+    for i, (prompt, system_prompt, temperature, max_tokens) in enumerate(requests):
+        lines.append(orjson.dumps({
+            "custom_id": f"case-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": completion_params(prompt, system_prompt, temperature, max_tokens, model_name)
+        }))
+    
+    batch_file = client.files.create(
+        file=("batch_input.jsonl", b"\n".join(lines)),
+        purpose="batch"
+    )
+    return client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+# Batch 任务的终止状态（除 completed 外均视为失败）
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def submit_batch_analysis(source_texts):
+    """
+    提交 Batch 分析任务后立即返回（不等待完成），结果通过 check_batch_analysis 查询
+    
+    未通过本地预检的文本直接给出预检结论，超长文本分块在线分析，其余文本提交 Batch 任务
+    
+    Args:
+        source_texts: 案件文本列表
+    
+    Returns:
+        可序列化的任务记录：{"batch_id", "cases", "results", "batched"}，
+        results 中待 Batch 返回的位置为 None，batched 为这些位置的下标（与 custom_id 顺序一致）
+    """
+    results = analyze_with_prefilter(source_texts, lambda texts: [None] * len(texts))
+    batched = [i for i, result in enumerate(results) if result is None]
+    batch_id = None
+    if batched:
+        batch_id = submit_batch([build_analyze_request(source_texts[i]) for i in batched]).id
+    return {"batch_id": batch_id, "cases": source_texts, "results": results, "batched": batched}
+
+def check_batch_analysis(pending):
+    """
+    查询一次 Batch 任务状态（不阻塞）
+    
+    Args:
+        pending: submit_batch_analysis 返回的任务记录
+    
+    Returns:
+        (状态, 进度文本, 分析结果列表)；任务尚未成功完成时分析结果为 None
+    """
+    if pending["batch_id"] is None:
+        return "completed", "", pending["results"]
+    
+    api_key_value, base_url_value = resolve_api_config()
+    if not api_key_value:
+        raise ValueError("未配置 API Key，请在侧边栏输入")
+    client = get_openai_client(api_key_value, base_url_value)
+    
+    batch = client.batches.retrieve(pending["batch_id"])
+    counts = batch.request_counts
+    progress = f"（{counts.completed}/{counts.total}）" if counts else ""
+    if batch.status != "completed" or not batch.output_file_id:
+        return batch.status, progress, None
+    
+    output = client.files.content(batch.output_file_id).text
+    by_id = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") == 200:
+            by_id[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        else:
+            by_id[item["custom_id"]] = f"❌ API 调用失败：{item.get('error') or response.get('body')}"
+    
+    results = list(pending["results"])
+    for request_index, case_index in enumerate(pending["batched"]):
+        results[case_index] = by_id.get(f"case-{request_index}", "❌ API 调用失败：Batch 结果缺失")
+    return batch.status, progress, results
+
+def cancel_batch(batch_id: str):
+    """取消 Batch 任务（尽力而为，失败时忽略）"""
+    api_key_value, base_url_value = resolve_api_config()
+    if not api_key_value or not batch_id:
+        return
+    try:
+        get_openai_client(api_key_value, base_url_value).batches.cancel(batch_id)
+    except Exception:
+        pass
+
+# csv 模块默认拒绝超过 131072 个字符的字段，而单个单元格可能是整篇长判决；
+# 取 C long 可表示的最大值（Windows 上 sys.maxsize 会溢出）
+CSV_FIELD_SIZE_LIMIT = 2 ** 31 - 1
+
+def read_cases_from_csv(file_data):
+    """从 CSV 中读取案件文本（优先使用 source_text 列，否则使用第一列）"""
+    csv.field_size_limit(CSV_FIELD_SIZE_LIMIT)
+    reader = csv.DictReader(io.StringIO(decode_text_bytes(file_data)))
+    if not reader.fieldnames:
+        return []
+    column = "source_text" if "source_text" in reader.fieldnames else reader.fieldnames[0]
+    return [row[column].strip() for row in reader if (row.get(column) or "").strip()]
+
+# ==========================================
+# 初始化 Session State
+# ==========================================
+# 各状态项的默认值（首次访问时写入，已有的值保持不变）
+_DEFAULTS = {
+    "source_text": "",
+    "source_analysis": "",
+    "generated_question": "",
+    "locked_question": "",
+    "generated_answer": "",
+    "question_locked": False,
+    "question_editor": "",
+    "answer_editor": "",
+    "question_field": "法律/金融/资本市场/证券与上市(IPO)",
+    "chinese_characteristics": "是",
+    "question_detected": False,
+    "detection_result": "",
+    "processed_file_hash": "",
+    "batch_results": [],
+    "pending_batch": None
+}
+for key, value in _DEFAULTS.items():
+    st.session_state.setdefault(key, value)
+
+# ==========================================
+# 会话检查点（刷新页面后恢复）
+# ==========================================
+# Session State 只保存在内存中，刷新浏览器即丢失；将关键状态写入本地 JSON，
+# 以 URL 中的 sid 参数标识会话，刷新后直接恢复，无需重新调用 API
+CHECKPOINT_DIR = Path.home() / ".legal_platform"
+CHECKPOINT_KEYS = (
+    "source_text", "source_analysis", "generated_question", "locked_question",
+    "generated_answer", "question_locked", "question_editor", "answer_editor",
+    "question_field", "chinese_characteristics", "question_detected", "detection_result",
+    "processed_file_hash", "pending_batch"
+)
+# 检查点保留时长（秒）：超过该时长未更新的会话文件在启动时清理
+CHECKPOINT_TTL = 7 * 24 * 3600
+_SESSION_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+@st.cache_resource(show_spinner=False, ttl=CACHE_PRUNE_INTERVAL)
+def prune_checkpoints():
+    """删除超过 CHECKPOINT_TTL 未更新的检查点文件（由 cache_resource 保证每个进程每小时至多执行一次）"""
+    prune_stale_files(CHECKPOINT_DIR, "session_*.json", CHECKPOINT_TTL)
+
+def checkpoint_path():
+    """当前浏览器会话的检查点文件（sid 缺失或不合法时生成新的 sid 并写入 URL）"""
+    sid = st.query_params.get("sid", "")
+    if not _SESSION_ID_RE.fullmatch(sid):
+        sid = uuid.uuid4().hex
+        st.query_params["sid"] = sid
+    return CHECKPOINT_DIR / f"session_{sid}.json"
+
+def restore_checkpoint():
+    """每个会话首次运行时从检查点恢复状态（须在创建组件之前调用）"""
+    if st.session_state.get("_checkpoint_restored"):
+        return
+    st.session_state._checkpoint_restored = True
+    prune_checkpoints()
+    try:
+        data = orjson.loads(checkpoint_path().read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return
+    for key in CHECKPOINT_KEYS:
+        if key in data:
+            st.session_state[key] = data[key]
+
+def checkpoint_session():
+    """
+    将关键状态写入检查点（内容与上次写入相同时跳过，连续 rerun 不会反复写盘）
+    
+    状态仍为默认值时不写文件（已有的检查点直接删除），避免每个只打开过页面的会话都留下文件；
+    检查点包含判决原文，目录与文件仅对当前用户可读写
+    """
+    state = {key: st.session_state[key] for key in CHECKPOINT_KEYS}
+    payload = orjson.dumps(state)
+    digest = hashlib.blake2b(payload, digest_size=16).digest()
+    if digest == st.session_state.get("_checkpoint_digest"):
+        return
+    path = checkpoint_path()
+    try:
+        if all(state[key] == _DEFAULTS[key] for key in CHECKPOINT_KEYS):
+            path.unlink(missing_ok=True)
+        else:
+            ensure_private_dir(CHECKPOINT_DIR)
+            write_private_file(path, payload)
+    except OSError:
+        return
+    st.session_state._checkpoint_digest = digest
+
+restore_checkpoint()
+
+def source_text_stats():
+    """原始案件文本的字符数与 token 数（文本变化时才重新统计，rerun 时直接复用）"""
+    text = st.session_state.source_text
+    stats = st.session_state.get("_source_text_stats")
+    if stats is None or stats["text"] != text:
+        stats = {"text": text, "length": len(text), "tokens": count_tokens(text)}
+        st.session_state._source_text_stats = stats
+    return stats
+
+# ==========================================
+# 文件解析函数
+# ==========================================
+# 解析库只在首次上传对应类型的文件时导入；脚本每次 rerun 都会重新执行，
+# 因此用 st.cache_resource（而非模块级 lru_cache）在进程内保留导入结果
+@st.cache_resource(show_spinner=False)
+def _fitz():
+    """延迟导入 PyMuPDF（新版模块名为 pymupdf，旧版为 fitz），未安装时返回 None"""
+    try:
+        import pymupdf
+        return pymupdf
+    except ImportError:
+        pass
+    try:
+        import fitz
+    except ImportError:
+        return None
+    return fitz
+
+@st.cache_resource(show_spinner=False)
+def _pypdfium2():
+    """延迟导入 pypdfium2，未安装时返回 None"""
+    try:
+        import pypdfium2
+    except ImportError:
+        return None
+    return pypdfium2
+
+@st.cache_resource(show_spinner=False)
+def _pdfplumber():
+    """延迟导入 pdfplumber（未安装时抛出 ImportError）"""
+    import pdfplumber
+    return pdfplumber
+
+@st.cache_resource(show_spinner=False)
+def _docx_document():
+    """延迟导入 python-docx 的 Document（未安装时抛出 ImportError）"""
+    from docx import Document
+    return Document
+
+# 文本文件的候选编码（依次尝试）：UTF-8（自动去除 BOM）、中文法律文书常见的 GB18030
+TEXT_ENCODINGS = ("utf-8-sig", "gb18030")
+# 增量解码的分块大小（字节）
+DECODE_CHUNK_SIZE = 64 * 1024
+
+def decode_text_bytes(data) -> str:
+    """按候选编码解码上传的文本内容（接受 bytes 或 memoryview），均失败时以替换字符兜底"""
+    view = memoryview(data)
+    for encoding in TEXT_ENCODINGS:
+        try:
+            return _decode_incrementally(view, encoding)
+        except UnicodeDecodeError:
+            continue
+    return bytes(view).decode(TEXT_ENCODINGS[-1], errors="replace")
+
+def _decode_incrementally(view: memoryview, encoding: str) -> str:
+    """分块增量解码到 StringIO，不额外复制整份字节内容"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    buf = io.StringIO()
+    for start in range(0, len(view), DECODE_CHUNK_SIZE):
+        buf.write(decoder.decode(view[start:start + DECODE_CHUNK_SIZE]))
+    buf.write(decoder.decode(b"", final=True))
+    return buf.getvalue()
+
+def join_page_texts(page_texts) -> str:
+    """将逐页产出的文本写入 StringIO，页间以空行分隔（不保留中间的页面文本列表）"""
+    buf = io.StringIO()
+    for text in page_texts:
+        if text:
+            if buf.tell():
+                buf.write("\n\n")
+            buf.write(text)
+    return buf.getvalue()
+
+# PDF 解析结果的磁盘缓存目录（按文件内容哈希命名，进程重启后仍可复用）
+PDF_CACHE_DIR = CACHE_DIR / "pdf"
+# PDF 缓存的保留时长（秒）与总大小上限（字节）
+PDF_CACHE_TTL = 7 * 24 * 3600
+PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+@st.cache_resource(show_spinner=False, ttl=CACHE_PRUNE_INTERVAL)
+def prune_pdf_cache():
+    """清理过期的 PDF 解析缓存，总大小超出上限时删除最久未使用的文件（每个进程每小时至多执行一次）"""
+    prune_stale_files(PDF_CACHE_DIR, "*.txt", PDF_CACHE_TTL, PDF_CACHE_MAX_BYTES)
+
+def resolve_pdf_backend():
+    """选择 PDF 解析库：依次尝试 PyMuPDF（MuPDF）、pypdfium2（PDFium），均未安装时回退到纯 Python 的 pdfplumber"""
+    fitz = _fitz()
+    if fitz is not None:
+        return "fitz", fitz
+    pdfium = _pypdfium2()
+    if pdfium is not None:
+        return "pypdfium2", pdfium
+    return "pdfplumber", _pdfplumber()
+
+def file_fingerprint(file_data) -> str:
+    """计算文件内容指纹（blake2b 直接读取 bytes 或 memoryview，不复制内容）"""
+    return hashlib.blake2b(file_data, digest_size=16).hexdigest()
+
+def extract_pdf_text(file_data, backend=None, on_page=None, file_hash: str = None) -> str:
+    """
+    提取 PDF 文本：先查磁盘缓存，未命中时解析并写入缓存
+    
+    Args:
+        file_data: PDF 文件内容（bytes 或上传文件 getbuffer() 得到的 memoryview）
+        backend: resolve_pdf_backend() 的返回值；在后台线程中调用时由调用方预先解析传入
+        on_page: 每解析完一页调用一次的回调 on_page(已完成页数, 总页数)
+        file_hash: 调用方已计算的 file_fingerprint()，省略时自动计算
+    
+    Returns:
+        提取的文本
+    """
+    cache_path = PDF_CACHE_DIR / f"{file_hash or file_fingerprint(file_data)}.txt"
+    try:
+        text = cache_path.read_text(encoding="utf-8")
+    except OSError:
+        text = None
+    if text is not None:
+        # 更新修改时间，按大小清理时优先保留最近使用的文件
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return text
+    
+    text = parse_pdf_text(file_data, backend, on_page)
+    try:
+        ensure_private_dir(PDF_CACHE_DIR)
+        write_private_file(cache_path, text.encode("utf-8"))
+    except OSError:
+        pass
+    return text
+
+def parse_pdf_text(file_data, backend=None, on_page=None) -> str:
+    """使用指定的解析库逐页解析 PDF 文本（只在缓存未命中、确需解析时才把 memoryview 复制为 bytes）"""
+    backend_name, module = backend or resolve_pdf_backend()
+    if backend_name == "fitz":
+        # PyMuPDF 的 stream 只接受 bytes/bytearray/BytesIO；对 bytes 调用 bytes() 不会复制
+        with module.open(stream=bytes(file_data), filetype="pdf") as doc:
+            return join_page_texts(_report_pages((page.get_text("text") for page in doc), len(doc), on_page))
+    
+    if backend_name == "pypdfium2":
+        pdf = module.PdfDocument(bytes(file_data))
+        try:
+            return join_page_texts(_report_pages(_pdfium_page_texts(pdf), len(pdf), on_page))
+        finally:
+            pdf.close()
+    
+    with module.open(io.BytesIO(file_data)) as pdf:
+        return join_page_texts(_report_pages(_pdfplumber_page_texts(pdf), len(pdf.pages), on_page))
+
+def _report_pages(page_texts, total: int, on_page=None):
+    """透传逐页文本，每页完成后回调报告进度"""
+    for done, text in enumerate(page_texts, start=1):
+        yield text
+        if on_page is not None:
+            on_page(done, total)
+
+def _pdfium_page_texts(pdf):
+    """逐页提取文本，每页提取后立即关闭页面对象"""
+    for page in pdf:
+        textpage = page.get_textpage()
+        text = textpage.get_text_range()
+        textpage.close()
+        page.close()
+        yield text
+
+def _pdfplumber_page_texts(pdf):
+    """逐页提取文本，每页提取后立即释放该页缓存的版面对象，降低大文件的峰值内存"""
+    for page in pdf.pages:
+        text = page.extract_text()
+        page.flush_cache()
+        yield text
+
+@st.cache_resource(show_spinner=False)
+def _extraction_executor():
+    """后台解析文件使用的线程池（进程内共享）"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="file-extract")
+
+def extract_pdf_text_with_progress(file_data, file_hash: str = None) -> str:
+    """在后台线程中解析 PDF，同时在页面上显示逐页进度"""
+    # 解析库在主线程中导入（未安装时的 ImportError 由调用方处理），后台线程不访问 Streamlit 缓存
+    backend = resolve_pdf_backend()
+    prune_pdf_cache()
+    progress = {"done": 0, "total": 0}
+    
+    def on_page(done, total):
+        progress["done"], progress["total"] = done, total
+    
+    progress_bar = st.progress(0.0, text="正在解析 PDF...")
+    future = _extraction_executor().submit(extract_pdf_text, file_data, backend, on_page, file_hash)
+    while not future.done():
+        if progress["total"]:
+            progress_bar.progress(
+                progress["done"] / progress["total"],
+                text=f"正在解析 PDF（{progress['done']}/{progress['total']} 页）..."
+            )
+        time.sleep(0.1)
+    progress_bar.empty()
+    return future.result()
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text_cached(file_hash: str, ext: str, _file_buffer) -> str:
+    """
+    按扩展名提取上传文件的文本（PDF 见 extract_pdf_text_with_progress）
+    
+    按 file_fingerprint() 缓存，rerun 时无需重复解析；
+    _file_buffer 以下划线开头，不参与缓存键计算，Streamlit 无需再对整份内容做哈希
+    """
+    if ext == "docx":
+        doc = _docx_document()(io.BytesIO(_file_buffer))
+        return "\n".join([para.text for para in doc.paragraphs])
+    
+    # 文本文件处理（txt, md 等）
+    return decode_text_bytes(_file_buffer)
+
+# ==========================================
+# 文件保存函数
+# ==========================================
+# 数据集文件：每条记录一行（JSONL），追加写入
+DATASET_FILENAME = "legal_data.jsonl"
+
+def build_record(source_text: str, question: str, answer: str):
+    """构建一条待保存的数据记录（timestamp 与 created_at 取自同一时刻）"""
+    now = datetime.now()
+    return {
+        "timestamp": now.strftime("%Y%m%d_%H%M%S"),
+        "source_text": source_text,
+        "question": question,
+        "answer": answer,
+        "question_field": st.session_state.question_field,
+        "chinese_characteristics": st.session_state.chinese_characteristics,
+        "created_at": now.isoformat()
+    }
+
+def save_to_file(source_text: str, question: str, answer: str):
+    """追加保存数据到 Auto 文件夹下的数据集文件（JSONL）"""
+    try:
+        # 确保 Auto 文件夹存在
+        auto_dir = Path(__file__).parent  # Auto 文件夹
+        auto_dir.mkdir(exist_ok=True)
+        filepath = auto_dir / DATASET_FILENAME
+        
+        # 追加一行 JSON 记录
+        data = build_record(source_text, question, answer)
+        with open(filepath, "ab") as f:
+            f.write(orjson.dumps(data) + b"\n")
+        
+        return filepath, None
+    except Exception as e:
+        return None, str(e)
+
+def export_snapshot(source_text: str, question: str, answer: str):
+    """导出当前数据为单独的带时间戳 JSON 文件（快照）"""
+    try:
+        # 确保 Auto 文件夹存在
+        auto_dir = Path(__file__).parent  # Auto 文件夹
+        auto_dir.mkdir(exist_ok=True)
+        
+        # 构建数据字典，文件名使用时间戳
+        data = build_record(source_text, question, answer)
+        filepath = auto_dir / f"legal_data_{data['timestamp']}.json"
+        
+        # 保存为 JSON（orjson 直接输出 UTF-8 字节，中文不转义，一次写入）
+        filepath.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        
+        return filepath, None
+    except Exception as e:
+        return None, str(e)
+
+# ==========================================
+# 模块局部刷新
+# ==========================================
+# 各模块均为 st.fragment：模块内的交互只重新运行该模块。
+# 只有影响其他模块显示的状态发生变化时，才整页重新运行
+def module_signature():
+    """影响其他模块显示的状态"""
+    return (
+        bool(st.session_state.source_text),
+        st.session_state.question_locked,
+        st.session_state.locked_question
+    )
+
+def rerun_app_if_modules_changed():
+    """模块运行结束时调用：跨模块状态发生变化时整页重新运行"""
+    signature = module_signature()
+    if signature != st.session_state.get("_module_signature"):
+        st.session_state._module_signature = signature
+        st.rerun()
+
+# 记录整页运行开始时的跨模块状态（模块局部重新运行时不会执行到这里）
+st.session_state._module_signature = module_signature()
+
+# ==========================================
+# 模块 1：原始案件处理模块
+# ==========================================
+st.markdown('<div class="section-header">1. 原始案件素材</div>', unsafe_allow_html=True)
+
+@st.fragment
+def render_source_module():
+    """模块 1：输入原始案件素材并分析"""
+    st.html(render_static_markdown("""
+    **说明：** 请选择您深度完成过的工作（如论文、研究报告、课程作业、项目描述等）。
+    题目应该专业、真实、信息完整，有详细的要求和示例。
+    """))
+
+    col1, col2 = st.columns([3, 1])
+
+    with col1:
+        st.markdown('<div class="field-label">* 原始案件文本</div>', unsafe_allow_html=True)
+        
+        # 文件上传功能（放在 text_area 之前，确保文件上传后能正确更新）
+        uploaded_file = st.file_uploader(
+            "或上传文本文件",
+            type=["txt", "md", "docx", "pdf"],
+            help="支持上传 .txt、.md、.docx 或 .pdf 文件",
+            label_visibility="collapsed"
+        )
+        
+        # 处理文件上传（按文件内容指纹判断，避免重复处理导致无限循环）
+        if uploaded_file is not None:
+            # getbuffer() 返回上传内容的 memoryview，计算指纹时不复制字节
+            file_buffer = uploaded_file.getbuffer()
+            file_hash = file_fingerprint(file_buffer)
+            # 检查是否已经处理过这个文件
+            if file_hash != st.session_state.processed_file_hash:
+                current_file_name = uploaded_file.name
+                try:
+                    file_extension = current_file_name.split('.')[-1].lower()
+                    extracted_text = ""
+                    
+                    try:
+                        if file_extension == 'pdf':
+                            extracted_text = extract_pdf_text_with_progress(file_buffer, file_hash)
+                        else:
+                            extracted_text = extract_text_cached(file_hash, file_extension, file_buffer)
+                        if file_extension == 'pdf' and not extracted_text.strip():
+                            st.warning("⚠️ PDF 文件似乎没有可提取的文本内容，可能是扫描版图片。")
+                    except ImportError:
+                        if file_extension == 'pdf':
+                            st.error("❌ 请安装 pymupdf、pypdfium2 或 pdfplumber 库以支持 PDF 文件：pip install pymupdf")
+                        else:
+                            st.warning("⚠️ 请安装 python-docx 库以支持 .docx 文件：pip install python-docx")
+                            extracted_text = decode_text_bytes(file_buffer)
+                    except Exception as e:
+                        if file_extension == 'pdf':
+                            st.error(f"❌ PDF 文件读取失败：{str(e)}")
+                        elif file_extension == 'docx':
+                            st.error(f"❌ Word 文档读取失败：{str(e)}")
+                        else:
+                            raise
+                    
+                    if extracted_text.strip():
+                        st.session_state.source_text = extracted_text
+                        st.session_state.processed_file_hash = file_hash  # 标记已处理
+                        st.success(f"✅ 文件 '{current_file_name}' 已成功加载（共 {len(extracted_text)} 字符）")
+                    else:
+                        st.warning("⚠️ 文件内容为空，请检查文件格式是否正确。")
+                        
+                except Exception as e:
+                    st.error(f"❌ 文件读取失败：{str(e)}")
+            # 如果文件已处理过，不再重复处理（避免无限循环）
+        # 注意：不要在没有上传文件时清除 processed_file_hash，因为 rerun 后 uploaded_file 会暂时为 None
+        # 只有在用户上传内容不同的文件时，processed_file_hash 才会自然失效
+        
+        # 文本输入框直接绑定 session_state["source_text"]（唯一数据源）
+        # 文件上传时在组件创建之前写入 session_state，因此无需再做同步
+        st.text_area(
+            "案件文本",
+            height=250,
+            placeholder="请在此输入或粘贴原始判决文本、案件描述等...",
+            help="支持直接输入文本或从文件复制粘贴",
+            label_visibility="collapsed",
+            key="source_text"
+        )
+        
+        if st.session_state.source_text:
+            source_tokens = source_text_stats()["tokens"]
+            caption = f"输入 {source_tokens} tokens"
+            if source_tokens > ANSWER_TOKEN_CAP:
+                caption += (
+                    f"（生成题目时将截断至 {QUESTION_TOKEN_CAP} tokens；"
+                    f"生成答案时将选取与题目最相关的片段，共不超过 {ANSWER_TOKEN_CAP} tokens）"
+                )
+            elif source_tokens > QUESTION_TOKEN_CAP:
+                caption += f"（生成题目时将截断至 {QUESTION_TOKEN_CAP} tokens）"
+            if source_tokens > MAP_REDUCE_THRESHOLD_TOKENS:
+                caption += "，案件分析将分块进行"
+            st.caption(caption)
+
+    with col2:
+        st.markdown('<div class="field-label">操作</div>', unsafe_allow_html=True)
+        analyze_btn = st.button(
+            "🔍 分析案件",
+            type="primary",
+            use_container_width=True,
+            disabled=not st.session_state.source_text.strip()
+        )
+        
+        
+        analyze_generate_btn = st.button(
+            "⚡ 分析并生成题目",
+            use_container_width=True,
+            disabled=not st.session_state.source_text.strip(),
+            help="同时调用案件分析与题目生成，节省等待时间"
+        )
+        
+        if analyze_generate_btn and st.session_state.source_text.strip():
+            with st.spinner("正在并发调用 DeepSeek API 分析案件并生成题目..."):
+                analysis_result, generated = analyze_and_generate_question(st.session_state.source_text)
+                st.session_state.source_analysis = analysis_result
+                st.session_state.question_detected = True
+                st.session_state.detection_result = analysis_result
+                if generated and generated.strip() and not st.session_state.question_locked:
+                    st.session_state.generated_question = generated
+                    st.session_state.question_editor = generated
+                    # 题目显示在模块 2 中，需要整页重新运行
+                    st.rerun()
+
+    # 显示分析结果（放在模块1下方，确保能正确显示）
+    st.markdown("")  # 添加一些间距
+
+    # 分析过程以流式方式显示在结果区域，完成后由下方的分析结果替代
+    if analyze_btn and st.session_state.source_text.strip():
+        analysis_placeholder = st.empty()
+        # 首个 token 到达前先显示提示，避免页面在等待期间没有任何反馈
+        analysis_placeholder.info("⏳ 正在分析案件...")
+        analysis_result = analyze_source_text(st.session_state.source_text, stream_placeholder=analysis_placeholder)
+        analysis_placeholder.empty()
+        st.session_state.source_analysis = analysis_result
+        st.session_state.question_detected = True
+        st.session_state.detection_result = analysis_result
+    if st.session_state.source_analysis:
+        st.markdown('<div class="field-label">※ 案件分析结果</div>', unsafe_allow_html=True)
+        
+        analysis_text = st.session_state.source_analysis
+        
+        is_passed = is_analysis_passed(analysis_text)
+        
+        # 分析文本转义后放入 <pre>，由浏览器保留换行和空格；
+        # 使用 st.html 而非 st.markdown，文本中的空行不会截断 HTML 块
+        if is_passed:
+            st.html("""
+            <div class="detection-pass">
+                <strong>✅ 检测通过</strong>
+                <pre class="analysis-text">{}</pre>
+            </div>
+            """.format(html.escape(analysis_text)))
+        else:
+            st.html("""
+            <div class="detection-fail">
+                <strong>⚠️ 检测未通过</strong>
+                <pre class="analysis-text">{}</pre>
+                <small>提示：请检查案件复杂度是否符合要求（总分需≥6分）</small>
+            </div>
+            """.format(html.escape(analysis_text)))
+        
+        # 同时用普通 markdown 显示，确保内容可见
+        with st.expander("📋 查看详细分析结果", expanded=True):
+            st.markdown(analysis_text)
+    
+    checkpoint_session()
+    rerun_app_if_modules_changed()
+
+render_source_module()
+
+# ==========================================
+# 模块 2：题目构建模块
+# ==========================================
+st.markdown('<div class="section-header">2. 题目构建</div>', unsafe_allow_html=True)
+
+@st.fragment
+def render_question_module():
+    """模块 2：生成、编辑并锁定题目"""
+    # 按钮回调中只记录提示文本，在模块重新运行时显示（回调中不能直接调用 st.toast）
+    toast_message = st.session_state.pop("_question_toast", None)
+    if toast_message:
+        st.toast(toast_message)
+    
+    if not st.session_state.source_text:
+        st.warning("⚠️ 请先完成步骤 1：输入原始案件素材")
+    else:
+        # 题目设置（放在表单中：修改选项不会触发 rerun，点击"应用"后统一提交）
+        field_options = [
+            "法律/金融/资本市场/证券与上市(IPO)",
+            "法律/刑法/刑事案例分析",
+            "法律/民法/合同纠纷",
+            "法律/公司法/企业合规",
+            "金融/投资分析",
+            "金融/风险管理",
+            "医疗/临床诊断",
+            "医疗/治疗方案",
+            "科研/实验设计",
+            "其他专业领域"
+        ]
+        
+        with st.form("question_config"):
+            # 题目领域选择
+            st.markdown('<div class="field-label">* 题目领域</div>', unsafe_allow_html=True)
+            selected_field = st.selectbox(
+                "选择题目领域",
+                options=field_options,
+                index=field_options.index(st.session_state.question_field) if st.session_state.question_field in field_options else 0,
+                label_visibility="collapsed"
+            )
+            
+            # 中国特色
+            st.markdown('<div class="field-label">* 中国特色</div>', unsafe_allow_html=True)
+            chinese_char = st.radio(
+                "是否具有中国特色",
+                options=["是", "否"],
+                index=0 if st.session_state.chinese_characteristics == "是" else 1,
+                horizontal=True,
+                help="中国特色指深度依赖本土中国文化的题目，如中国政策、中国法律、中医等",
+                label_visibility="collapsed"
+            )
+            
+            config_submitted = st.form_submit_button("应用")
+        
+        if config_submitted:
+            st.session_state.question_field = selected_field
+            st.session_state.chinese_characteristics = chinese_char
+        
+        # 显示领域可用状态
+        col1, col2 = st.columns([1, 4])
+        with col1:
+            st.success("✅ 领域可用")
+        
+        # 题目内容
+        st.markdown('<div class="field-label">* 题目内容</div>', unsafe_allow_html=True)
+        
+        # 在创建组件之前，先处理生成题目的逻辑
+        generate_question_btn = st.button(
+            "🚀 生成题目",
+            type="primary",
+            key="generate_question_btn",
+            disabled=not st.session_state.source_text
+        )
+        
+        # 生成题目（在创建组件之前处理）
+        if generate_question_btn:
+            # 确保 source_text 存在且不为空
+            if not st.session_state.source_text or not st.session_state.source_text.strip():
+                st.error("❌ 错误：原始案件文本为空，请先完成模块1：输入原始案件素材")
+            else:
+                # 生成过程以流式方式显示，完成后写入下方的题目编辑框
+                question_placeholder = st.empty()
+                try:
+                    generated = generate_question(st.session_state.source_text, stream_placeholder=question_placeholder)
+                    question_placeholder.empty()
+                    if generated and generated.strip():
+                        # 确保在更新前，source_text 仍然存在（防止在生成过程中被清空）
+                        if st.session_state.source_text:
                             st.session_state.generated_question = generated
                             st.session_state.question_editor = generated
                             st.success("✅ 题目生成成功！")
-                            st.rerun()
                         else:
                             st.error("❌ 错误：原始案件文本在生成过程中丢失，请重新输入")
                     else:
@@ -584,175 +2154,362 @@ else:
                     # 确保数据不丢失
                     if not st.session_state.source_text:
                         st.warning("⚠️ 原始案件文本已丢失，请重新输入")
-    
-    # 如果题目已锁定，显示只读模式
-    if st.session_state.question_locked:
-        st.info("🔒 题目已锁定")
-        question_display = st.text_area(
-            "题目（已锁定）",
-            value=st.session_state.locked_question,
-            height=200,
-            disabled=True,
-            label_visibility="collapsed"
-        )
-    else:
-        question_input = st.text_area(
-            "题目内容",
-            value=st.session_state.question_editor,
-            height=200,
-            placeholder="题目将在此显示，您可以手动编辑...",
-            key="question_editor",
-            label_visibility="collapsed"
-        )
-        st.session_state.generated_question = question_input
-    
-    # 题目内容检测
-    if st.session_state.generated_question:
-        st.markdown('<div class="field-label">※ 题目内容检测</div>', unsafe_allow_html=True)
-        
-        # 检测逻辑（简化版，实际可以调用 API）
-        if len(st.session_state.generated_question) > 100:
-            detection_passed = True
-            detection_text = """
-            题目背景翔实，模拟了真实的法律案例分析场景；指令具体明确，涵盖了数据提取、策略梳理及多维度（效率、风控等）深度评价，
-            符合专家级认知复杂度要求；基于特定时间点的案件进行分析，具备客观性和稳定性。
-            """
+
+        # 如果题目已锁定，显示只读模式
+        if st.session_state.question_locked:
+            st.info("🔒 题目已锁定")
+            question_display = st.text_area(
+                "题目（已锁定）",
+                value=st.session_state.locked_question,
+                height=200,
+                disabled=True,
+                label_visibility="collapsed"
+            )
         else:
-            detection_passed = False
-            detection_text = "题目内容过短，请补充更详细的背景信息和具体要求。"
+            question_input = st.text_area(
+                "题目内容",
+                value=st.session_state.question_editor,
+                height=200,
+                placeholder="题目将在此显示，您可以手动编辑...",
+                key="question_editor",
+                label_visibility="collapsed"
+            )
+            st.session_state.generated_question = question_input
         
-        if detection_passed:
-            st.markdown(f"""
-            <div class="detection-pass">
-                <strong>✅ 检测通过</strong><br>
-                {detection_text}<br>
-                <small>检测时间：{datetime.now().strftime("%Y/%m/%d")}</small>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="detection-fail">
-                <strong>⚠️ 检测未通过</strong><br>
-                {detection_text}
-            </div>
-            """, unsafe_allow_html=True)
-    
-    # 操作按钮
-    col1, col2, col3 = st.columns([1, 1, 1])
-    with col1:
-        lock_question_btn = st.button(
-            "🔒 锁定题目",
-            type="secondary",
-            use_container_width=True,
-            disabled=st.session_state.question_locked or not st.session_state.generated_question.strip()
-        )
-    with col2:
-        unlock_question_btn = st.button(
-            "🔓 解锁题目",
-            use_container_width=True,
-            disabled=not st.session_state.question_locked
-        )
-    with col3:
-        pass
-    
-    # 锁定题目
-    if lock_question_btn:
-        if st.session_state.generated_question.strip():
-            st.session_state.locked_question = st.session_state.generated_question
-            st.session_state.question_locked = True
-            st.success("✅ 题目已锁定")
-            st.rerun()
+        # 题目内容检测
+        if st.session_state.generated_question:
+            st.markdown('<div class="field-label">※ 题目内容检测</div>', unsafe_allow_html=True)
+            
+            # 检测逻辑（简化版，实际可以调用 API）
+            if len(st.session_state.generated_question) > 100:
+                detection_passed = True
+                detection_text = """
+                题目背景翔实，模拟了真实的法律案例分析场景；指令具体明确，涵盖了数据提取、策略梳理及多维度（效率、风控等）深度评价，
+                符合专家级认知复杂度要求；基于特定时间点的案件进行分析，具备客观性和稳定性。
+                """
+            else:
+                detection_passed = False
+                detection_text = "题目内容过短，请补充更详细的背景信息和具体要求。"
+            
+            if detection_passed:
+                st.markdown(f"""
+                <div class="detection-pass">
+                    <strong>✅ 检测通过</strong><br>
+                    {detection_text}<br>
+                    <small>检测时间：{datetime.now().strftime("%Y/%m/%d")}</small>
+                </div>
+                """, unsafe_allow_html=True)
+            else:
+                st.markdown(f"""
+                <div class="detection-fail">
+                    <strong>⚠️ 检测未通过</strong><br>
+                    {detection_text}
+                </div>
+                """, unsafe_allow_html=True)
+        
+        # 锁定/解锁通过按钮回调完成：回调在模块重新运行前更新状态，模块结束时再整页刷新模块 3
+        def lock_question():
+            """锁定题目"""
+            question = st.session_state.get("question_editor") or st.session_state.generated_question
+            if question.strip():
+                st.session_state.generated_question = question
+                st.session_state.locked_question = question
+                st.session_state.question_locked = True
+                # 用户通常紧接着生成答案：提前在后台开始生成
+                prefetch_answer(question, st.session_state.source_text)
+                st.session_state._question_toast = "✅ 题目已锁定"
+        
+        def unlock_question():
+            """解锁题目"""
+            st.session_state.question_locked = False
+            # 保留预生成任务：重新锁定同一题目时直接复用，题目被修改时按匹配键失效
+            # 解锁时，将锁定的题目内容恢复回可编辑状态
+            if st.session_state.locked_question:
+                st.session_state.question_editor = st.session_state.locked_question
+                st.session_state.generated_question = st.session_state.locked_question
+            st.session_state._question_toast = "🔓 题目已解锁，可以重新编辑"
+        
+        # 操作按钮
+        col1, col2, col3 = st.columns([1, 1, 1])
+        with col1:
+            st.button(
+                "🔒 锁定题目",
+                type="secondary",
+                use_container_width=True,
+                disabled=st.session_state.question_locked or not st.session_state.generated_question.strip(),
+                on_click=lock_question
+            )
+        with col2:
+            st.button(
+                "🔓 解锁题目",
+                use_container_width=True,
+                disabled=not st.session_state.question_locked,
+                on_click=unlock_question
+            )
+        with col3:
+            pass
     
-    # 解锁题目
-    if unlock_question_btn:
-        st.session_state.question_locked = False
-        # 解锁时，将锁定的题目内容恢复回可编辑状态
-        if st.session_state.locked_question:
-            st.session_state.question_editor = st.session_state.locked_question
-            st.session_state.generated_question = st.session_state.locked_question
-        st.info("🔓 题目已解锁，可以重新编辑")
-        st.rerun()
+    checkpoint_session()
+    rerun_app_if_modules_changed()
+
+render_question_module()
 
 # ==========================================
 # 模块 3：解题思路与答案生成模块
 # ==========================================
 st.markdown('<div class="section-header">3. 模型回答（标准答案）</div>', unsafe_allow_html=True)
 
-st.markdown("""
-**说明：** 在继续之前，请先评估 AI 的回答水平。我们需要 AI 无法很好解决的问题。
-如果模型回答很好，请增加题目难度（如增加场景复杂度或干扰信息）；否则，该题目不适合。
-""")
-
-if not st.session_state.question_locked:
-    st.warning("⚠️ 请先完成步骤 2：生成并锁定题目")
-elif not st.session_state.locked_question:
-    st.warning("⚠️ 题目内容为空，请先生成题目")
-else:
-    # 在创建组件之前，先处理生成答案的逻辑
-    generate_answer_btn = st.button(
-        "🚀 生成标准答案",
-        type="primary",
-        key="generate_answer_btn",
-        disabled=not st.session_state.question_locked
-    )
-    
-    # 生成答案（在创建组件之前处理）
-    if generate_answer_btn:
-        with st.spinner("正在调用 DeepSeek API 生成答案..."):
-            generated = generate_answer(
-                st.session_state.locked_question,
-                st.session_state.source_text
-            )
+@st.fragment
+def render_answer_module():
+    """模块 3：生成、编辑并保存标准答案"""
+    st.html(render_static_markdown("""
+    **说明：** 在继续之前，请先评估 AI 的回答水平。我们需要 AI 无法很好解决的问题。
+    如果模型回答很好，请增加题目难度（如增加场景复杂度或干扰信息）；否则，该题目不适合。
+    """))
+
+    if not st.session_state.question_locked:
+        st.warning("⚠️ 请先完成步骤 2：生成并锁定题目")
+    elif not st.session_state.locked_question:
+        st.warning("⚠️ 题目内容为空，请先生成题目")
+    else:
+        # 在创建组件之前，先处理生成答案的逻辑
+        generate_answer_btn = st.button(
+            "🚀 生成标准答案",
+            type="primary",
+            key="generate_answer_btn",
+            disabled=not st.session_state.question_locked
+        )
+        
+        # 生成答案（在创建组件之前处理）
+        if generate_answer_btn:
+            # 优先使用锁定题目时在后台预生成的答案
+            with st.spinner("正在获取预生成的答案..."):
+                generated = take_prefetched_answer(
+                    st.session_state.locked_question,
+                    st.session_state.source_text
+                )
+            if generated is None:
+                # 流式输出：首个 token 到达即开始渲染，完成后由下方答案编辑框接管显示
+                answer_placeholder = st.empty()
+                generated = generate_answer(
+                    st.session_state.locked_question,
+                    st.session_state.source_text,
+                    stream_placeholder=answer_placeholder
+                )
+                answer_placeholder.empty()
             st.session_state.generated_answer = generated
             st.session_state.answer_editor = generated
-        st.success("✅ 答案生成成功！")
-        st.rerun()
-    
-    st.markdown('<div class="field-label">* 答案内容</div>', unsafe_allow_html=True)
-    answer_input = st.text_area(
-        "标准答案",
-        value=st.session_state.answer_editor,
-        height=350,
-        placeholder="答案将在此显示，您可以手动编辑...",
-        key="answer_editor",
-        label_visibility="collapsed"
-    )
-    st.session_state.generated_answer = answer_input
-    
-    # 保存按钮
-    col1, col2, col3 = st.columns([1, 1, 1])
-    with col2:
-        save_btn = st.button(
-            "💾 锁定并保存",
-            type="primary",
-            use_container_width=True,
-            disabled=not st.session_state.generated_answer.strip()
+            st.success("✅ 答案生成成功！")
+        
+        st.markdown('<div class="field-label">* 答案内容</div>', unsafe_allow_html=True)
+        answer_input = st.text_area(
+            "标准答案",
+            value=st.session_state.answer_editor,
+            height=350,
+            placeholder="答案将在此显示，您可以手动编辑...",
+            key="answer_editor",
+            label_visibility="collapsed"
         )
-    
-    # 保存数据
-    if save_btn:
-        if st.session_state.generated_answer.strip():
-            filepath, error = save_to_file(
+        st.session_state.generated_answer = answer_input
+        
+        # 保存按钮
+        col1, col2, col3 = st.columns([1, 1, 1])
+        with col2:
+            save_btn = st.button(
+                "💾 锁定并保存",
+                type="primary",
+                use_container_width=True,
+                disabled=not st.session_state.generated_answer.strip()
+            )
+        with col3:
+            export_btn = st.button(
+                "📤 导出快照",
+                use_container_width=True,
+                disabled=not st.session_state.generated_answer.strip(),
+                help="额外导出一份独立的带时间戳 JSON 文件"
+            )
+        
+        # 导出快照
+        if export_btn and st.session_state.generated_answer.strip():
+            filepath, error = export_snapshot(
                 st.session_state.source_text,
                 st.session_state.locked_question,
                 st.session_state.generated_answer
             )
-            
             if error:
-                st.error(f"❌ 保存失败：{error}")
+                st.error(f"❌ 导出失败：{error}")
             else:
-                st.success(f"✅ 数据已保存到：{filepath}")
+                st.success(f"✅ 快照已导出到：{filepath}")
+        
+        # 保存数据
+        if save_btn:
+            if st.session_state.generated_answer.strip():
+                filepath, error = save_to_file(
+                    st.session_state.source_text,
+                    st.session_state.locked_question,
+                    st.session_state.generated_answer
+                )
                 
-                # 显示保存的数据预览
-                with st.expander("📋 查看保存的数据", expanded=False):
-                    st.json({
-                        "题目领域": st.session_state.question_field,
-                        "中国特色": st.session_state.chinese_characteristics,
-                        "原始文本长度": len(st.session_state.source_text),
-                        "题目": st.session_state.locked_question[:100] + "..." if len(st.session_state.locked_question) > 100 else st.session_state.locked_question,
-                        "答案长度": len(st.session_state.generated_answer),
-                        "保存路径": str(filepath)
-                    })
+                if error:
+                    st.error(f"❌ 保存失败：{error}")
+                else:
+                    st.success(f"✅ 数据已保存到：{filepath}")
+                    
+                    # 显示保存的数据预览
+                    with st.expander("📋 查看保存的数据", expanded=False):
+                        st.json({
+                            "题目领域": st.session_state.question_field,
+                            "中国特色": st.session_state.chinese_characteristics,
+                            "原始文本长度": source_text_stats()["length"],
+                            "题目": st.session_state.locked_question[:100] + "..." if len(st.session_state.locked_question) > 100 else st.session_state.locked_question,
+                            "答案长度": len(st.session_state.generated_answer),
+                            "保存路径": str(filepath)
+                        })
+    
+    checkpoint_session()
+    rerun_app_if_modules_changed()
+
+render_answer_module()
+
+# ==========================================
+# 批量生成：上传 CSV 批量分析案件
+# ==========================================
+st.markdown('<div class="section-header">批量生成（CSV）</div>', unsafe_allow_html=True)
+
+def store_batch_results(cases, analyses, generate_questions: bool):
+    """汇总分析结果（按需批量生成题目）并写入 session_state.batch_results"""
+    questions = [{"question": "", "evaluation": ""}] * len(cases)
+    if generate_questions:
+        with st.spinner(f"正在为 {len(cases)} 个案件批量生成题目..."):
+            questions = generate_questions_bulk(cases)
+    st.session_state.batch_results = [
+        {"source_text": case, "analysis": analysis, **question}
+        for case, analysis, question in zip(cases, analyses, questions)
+    ]
+
+@st.fragment(run_every=BATCH_POLL_INTERVAL)
+def render_batch_status():
+    """
+    定时查询进行中的 Batch 任务状态
+    
+    任务记录保存在 session_state.pending_batch 并写入检查点，刷新页面或点击其他按钮都不会丢失任务；
+    每次只查询一次状态，不阻塞脚本
+    """
+    pending = st.session_state.pending_batch
+    if not pending:
+        return
+    
+    try:
+        status, progress, analyses = check_batch_analysis(pending)
+    except Exception as e:
+        st.warning(f"⚠️ Batch 任务状态查询失败（{format_api_error(e)}），将在 {BATCH_POLL_INTERVAL} 秒后重试")
+        return
+    
+    if analyses is not None:
+        st.session_state.pending_batch = None
+        store_batch_results(pending["cases"], analyses, pending["generate_questions"])
+        checkpoint_session()
+        st.rerun()
+    
+    if status in BATCH_FINAL_STATUSES:
+        st.error(f"❌ Batch 任务 {pending['batch_id']} 未能完成（状态：{status}）")
+        if st.button("⚡ 改为在线并发分析", key="batch_fallback_btn"):
+            st.session_state.pending_batch = None
+            with st.spinner(f"正在并发分析 {len(pending['cases'])} 个案件..."):
+                analyses = analyze_sources_concurrently(pending["cases"])
+            store_batch_results(pending["cases"], analyses, pending["generate_questions"])
+            checkpoint_session()
+            st.rerun()
+    else:
+        st.info(
+            f"⏳ Batch 任务 {pending['batch_id']} 进行中（状态：{status}）{progress}，"
+            f"页面每 {BATCH_POLL_INTERVAL} 秒自动刷新状态，可以先处理其他工作"
+        )
+    
+    if st.button("🗑️ 放弃该任务", key="batch_discard_btn"):
+        cancel_batch(pending["batch_id"])
+        st.session_state.pending_batch = None
+        checkpoint_session()
+        st.rerun()
+
+with st.expander("📦 上传CSV批量生成", expanded=False):
+    st.markdown(f"""
+    **说明：** 上传包含 `source_text` 列的 CSV 文件（无该列时使用第一列），每行一个案件。
+    不超过 {BATCH_MODE_THRESHOLD} 个案件时在线并发分析；超过时通过 Batch API 离线提交（费用减半，最长 24 小时完成）。
+    """)
+    
+    uploaded_csv = st.file_uploader(
+        "上传 CSV 文件",
+        type=["csv"],
+        key="batch_csv_uploader",
+        label_visibility="collapsed"
+    )
+    
+    batch_generate_questions = st.checkbox(
+        f"同时生成题目（每 {QUESTION_BULK_SIZE} 个案件合并为一次请求）",
+        key="batch_generate_questions"
+    )
+    
+    batch_btn = st.button(
+        "📦 开始批量分析",
+        type="primary",
+        disabled=uploaded_csv is None or bool(st.session_state.pending_batch)
+    )
+    
+    if batch_btn and uploaded_csv is not None:
+        try:
+            cases = read_cases_from_csv(uploaded_csv.getbuffer())
+        except Exception as e:
+            st.error(f"❌ CSV 文件读取失败：{str(e)}")
+            cases = []
+        
+        if not cases:
+            st.warning("⚠️ CSV 文件中没有可用的案件文本。")
+        else:
+            submitted = False
+            if len(cases) > BATCH_MODE_THRESHOLD:
+                with st.spinner(f"正在提交 {len(cases)} 个案件的 Batch 任务..."):
+                    try:
+                        pending = submit_batch_analysis(cases)
+                        pending["generate_questions"] = batch_generate_questions
+                        st.session_state.pending_batch = pending
+                        checkpoint_session()
+                        submitted = True
+                    except Exception as e:
+                        st.warning(f"⚠️ Batch API 不可用（{str(e)}），改为在线并发分析")
+            if not submitted:
+                with st.spinner(f"正在并发分析 {len(cases)} 个案件..."):
+                    analyses = analyze_sources_concurrently(cases)
+                store_batch_results(cases, analyses, batch_generate_questions)
+                st.success(f"✅ 批量处理完成（共 {len(cases)} 个案件）")
+    
+    render_batch_status()
+    
+    if st.session_state.batch_results:
+        has_questions = any(item["question"] for item in st.session_state.batch_results)
+        st.dataframe(
+            [
+                {
+                    "序号": i + 1,
+                    "案件文本": item["source_text"][:100],
+                    "是否通过": VERDICT_LABELS[parse_analysis_verdict(item["analysis"])],
+                    "分析结果": item["analysis"],
+                    **({"题目": item["question"], "题目评价": item["evaluation"]} if has_questions else {})
+                }
+                for i, item in enumerate(st.session_state.batch_results)
+            ],
+            use_container_width=True
+        )
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=["source_text", "analysis", "question", "evaluation"])
+        writer.writeheader()
+        writer.writerows(st.session_state.batch_results)
+        st.download_button(
+            "⬇️ 下载分析结果",
+            data=output.getvalue().encode("utf-8-sig"),
+            file_name=f"batch_analysis_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+            mime="text/csv"
+        )
 
 # ==========================================
 # 底部：重置功能
@@ -763,7 +2520,8 @@ with col2:
     if st.button("🔄 重置所有数据", use_container_width=True):
         for key in ["source_text", "source_analysis", "generated_question", 
                    "locked_question", "generated_answer", "question_locked",
-                   "question_editor", "answer_editor", "question_detected", "detection_result"]:
+                   "question_editor", "answer_editor", "question_detected", "detection_result",
+                   "batch_results", "pending_batch"]:
             if key in st.session_state:
                 del st.session_state[key]
         st.rerun()